@@ -1,10 +1,11 @@
 __all__ = ["GeoLocDB"]
 
+import bisect
 import os
 import sys
 
-import geoip2.database
-from geoip2.errors import AddressNotFoundError
+import maxminddb
+import netaddr
 
 GEODB_FILES = ["GeoIP2-City.mmdb", "GeoLite2-City.mmdb"]
 GEODB_CITY_PATHS = ["/usr/share/GeoIP/", "/usr/local/share/GeoIP/"]
@@ -60,24 +61,104 @@ class GeoLocDB(object):
                 raise Exception(
                     "No GeoIP databases found.  Search in:", GEODB_CITY_PATHS
                 )
-        self.__reader = geoip2.database.Reader(database_path)
+        self.__reader = maxminddb.open_database(database_path)
+        # MaxMind records are constant across the network returned with each
+        # one, so resolved networks are cached as sorted, non-overlapping
+        # intervals: {version: ([first, ...], [(first, last, loc, country), ...])}
+        self.__cache = {4: ([], []), 6: ([], [])}
+
+    def __resolve(self, ip):
+        """Returns (first, last, location, country) for the database network
+        containing the netaddr.IPAddress ip.  location is (None, None) and
+        country is None for addresses not found in the database."""
+        ip_int = int(ip)
+        firsts, entries = self.__cache[ip.version]
+        i = bisect.bisect_right(firsts, ip_int) - 1
+        if i >= 0 and entries[i][1] >= ip_int:
+            return entries[i]
+
+        record, prefix_len = self.__reader.get_with_prefix_len(str(ip))
+        network = netaddr.IPNetwork("%s/%d" % (ip, prefix_len))
+        location = (None, None)
+        country = None
+        if record:
+            loc = record.get("location", {})
+            location = (loc.get("longitude"), loc.get("latitude"))
+            country = record.get("country", {}).get("names", {}).get("en", "")
+        entry = (network.first, network.last, location, country)
+        i = bisect.bisect_right(firsts, network.first)
+        firsts.insert(i, network.first)
+        entries.insert(i, entry)
+        return entry
+
+    def __walk(self, cidr):
+        """Generates (first, last, location, country) for each database
+        network overlapping the netaddr.IPNetwork cidr, clipped to cidr."""
+        current = cidr.first
+        while current <= cidr.last:
+            first, last, location, country = self.__resolve(
+                netaddr.IPAddress(current, cidr.version)
+            )
+            last = min(last, cidr.last)
+            yield max(first, cidr.first), last, location, country
+            current = last + 1
 
     def lookup(self, ip):
-        try:
-            # ip is expected to be a netaddr.IPAddress
-            response = self.__reader.city(str(ip))
-            if response == None:
-                return (None, None)
-            return (response.location.longitude, response.location.latitude)
-        except AddressNotFoundError:
-            return (None, None)
+        # ip is expected to be a netaddr.IPAddress
+        return self.__resolve(netaddr.IPAddress(ip))[2]
+
+    def lookup_cidr(self, cidr):
+        """Returns a list of (IPRange, location) pairs covering the
+        netaddr.IPNetwork cidr.  Adjacent ranges with the same location are
+        merged, and only one database read is needed per distinct network."""
+        results = []
+        for first, last, location, country in self.__walk(cidr):
+            if results and results[-1][1] == location:
+                results[-1] = (
+                    netaddr.IPRange(
+                        results[-1][0][0], netaddr.IPAddress(last, cidr.version)
+                    ),
+                    location,
+                )
+            else:
+                results.append(
+                    (
+                        netaddr.IPRange(
+                            netaddr.IPAddress(first, cidr.version),
+                            netaddr.IPAddress(last, cidr.version),
+                        ),
+                        location,
+                    )
+                )
+        return results
+
+    def check_restricted_cidrs(self, cidrs):
+        """Returns a dict of {country: IPSet} for the addresses in the
+        netaddr.IPSet cidrs that are located in restricted countries.  Work is
+        proportional to the number of distinct database networks, not the
+        number of addresses."""
+        restricted = dict()
+        for cidr in cidrs.iter_cidrs():
+            for first, last, location, country in self.__walk(cidr):
+                addresses = netaddr.IPRange(
+                    netaddr.IPAddress(first, cidr.version),
+                    netaddr.IPAddress(last, cidr.version),
+                )
+                if country is None:
+                    print >> sys.stderr, (
+                        "IPs %s not found in geolocation database" % addresses
+                    )
+                elif country in RESTRICTED_COUNTRIES:
+                    restricted.setdefault(country, netaddr.IPSet()).update(
+                        addresses.cidrs()
+                    )
+        return restricted
 
     def check_restricted_ip(self, ip):
-        try:
-            response = self.__reader.city(str(ip))
-            if response.country.name in RESTRICTED_COUNTRIES:
-                return response.country.name
-        except AddressNotFoundError:
+        country = self.__resolve(netaddr.IPAddress(ip))[3]
+        if country is None:
             print >> sys.stderr, "IP %s not found in geolocation database" % ip
+        elif country in RESTRICTED_COUNTRIES:
+            return country
 
         return ""
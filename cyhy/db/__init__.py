@@ -1,4 +1,8 @@
 from database import *
+from network_index import *
+from place_index import *
+from org_graph import *
+from owner_partition import *
 from host_state_manager import *
 from scheduler import *
 from chdatabase import *
@@ -6,6 +10,10 @@ from crypto import *
 from ticket_manager import *
 
 import database
+import network_index
+import place_index
+import org_graph
+import owner_partition
 import chdatabase
 import crypto
 import ticket_manager
@@ -13,6 +21,10 @@ import host_state_manager
 import scheduler
 
 __all__ = database.__all__
+__all__ += network_index.__all__
+__all__ += place_index.__all__
+__all__ += org_graph.__all__
+__all__ += owner_partition.__all__
 __all__ += chdatabase.__all__
 __all__ += crypto.__all__
 __all__ += ticket_manager.__all__
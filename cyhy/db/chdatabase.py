@@ -2,7 +2,14 @@ __all__ = ["CHDatabase"]
 
 import sys
 import datetime
+from collections import defaultdict
 import copy
+import json
+import os
+import socket
+import threading
+from uuid import uuid4
+from multiprocessing.pool import ThreadPool
 import progressbar as pb
 import logging
 
@@ -15,6 +22,7 @@ import time_calc
 import time
 import netaddr
 from bson import ObjectId
+from pymongo import ReadPreference
 import pandas as pd
 import numpy as np
 
@@ -39,12 +47,44 @@ class CHDatabase(object):
     SNAPSHOT_CLOSED_TICKET_HISTORY_DAYS = (
         365  # number of days of closed tickets to include in closed tix metrics
     )
-
-    def __init__(self, db, state_manager=None, scheduler=None, next_scan_limit=2000):
+    # snapshot pipelines are heavy read-only scans, so they are run on a
+    # secondary that has replicated the snapshot tags and is at most
+    # SNAPSHOT_MAX_STALENESS seconds behind; otherwise on the primary
+    SNAPSHOT_READ_PREFERENCE = ReadPreference.SECONDARY_PREFERRED
+    SNAPSHOT_MAX_STALENESS = 90  # seconds
+    SNAPSHOT_REPLICATION_WAIT = 10  # seconds to wait for secondaries to catch up
+    # RUNNING hosts whose claim has not been renewed for CLAIM_TIMEOUT seconds
+    # belong to a commander that has stopped, and are moved back to WAITING
+    CLAIM_TIMEOUT = 600  # seconds
+    CLAIM_RENEW_INTERVAL = 60  # seconds
+
+    def __init__(
+        self,
+        db,
+        state_manager=None,
+        scheduler=None,
+        next_scan_limit=2000,
+        commander_id=None,
+        partition=None,
+    ):
         """db: MongoDB instance
            state_manager: class that implements a HostStateManager
-           scheduler: class that implements a Scheduler"""
+           scheduler: class that implements a Scheduler
+           commander_id: unique ID used to claim hosts (default: host:pid:random)
+           partition: OwnerPartition of the owners this commander balances
+             and fetches hosts for (default: all owners)"""
         self.__db = db
+        if commander_id == None:
+            # hostname and pid repeat across containers, so add a random token
+            commander_id = "%s:%d:%s" % (
+                socket.gethostname(),
+                os.getpid(),
+                uuid4().hex[:8],
+            )
+        self.__commander_id = commander_id
+        self.__last_claim_maintenance = None
+        self.__partition = partition
+        self.__partition_owners = None  # cached owners in the partition
         self.__logger = logging.getLogger(__name__)
         self.__scheduler = scheduler
         self.__next_scan_limit = next_scan_limit
@@ -60,13 +100,42 @@ class CHDatabase(object):
     def __str__(self):
         return "<CHDatabase %s>" % (self.__db)
 
+    @property
+    def partition(self):
+        return self.__partition
+
+    def set_partition(self, partition):
+        """Changes the owners this commander works on, e.g. when the number of
+        commanders changes.  Hosts already claimed finish normally."""
+        self.__partition = partition
+        self.__partition_owners = None
+
+    def partition_owners(self):
+        """Returns the owners in this commander's partition, or None if it
+        works on all owners"""
+        if self.__partition == None:
+            return None
+        if self.__partition_owners == None:
+            requests = self.__db.RequestDoc.collection.find(
+                {"scan_types": SCAN_TYPE.CYHY}, {"_id": True}
+            )
+            self.__partition_owners = self.__partition.filter(
+                r["_id"] for r in requests
+            )
+        return self.__partition_owners
+
     def request_limits(self, when=None):
         # returns {owner: {stage:limit, stage:limit, ...}, ...}
+        # for the owners in this commander's partition
         if when == None:
             when = util.utcnow()
         requests = self.__db.RequestDoc.find({"scan_types": SCAN_TYPE.CYHY})
         results = {}
         for request in requests:
+            if self.__partition != None and not self.__partition.owns(
+                request["_id"]
+            ):
+                continue
             if request["period_start"] < when and time_calc.in_windows(
                 request["windows"], when
             ):
@@ -76,24 +145,70 @@ class CHDatabase(object):
             else:
                 limits = self.TEMP_OFF_CONCURRENCY
             results[request["_id"]] = limits
+        if self.__partition != None:
+            self.__partition_owners = sorted(results)
         return results
 
     def increase_ready_hosts(self, owner, stage, count):
         changed_count = self.__db.HostDoc.increase_ready_hosts(owner, stage, count)
-        tally = self.__db.TallyDoc.get_by_owner(owner)
-        tally.transfer(stage, STATUS.WAITING, stage, STATUS.READY, changed_count)
-        tally.save()
+        self.__tally_transfer(
+            owner, stage, STATUS.WAITING, stage, STATUS.READY, changed_count
+        )
         return changed_count
 
     def decrease_ready_hosts(self, owner, stage, count):
         changed_count = self.__db.HostDoc.decrease_ready_hosts(owner, stage, count)
-        tally = self.__db.TallyDoc.get_by_owner(owner)
-        tally.transfer(stage, STATUS.READY, stage, STATUS.WAITING, changed_count)
-        tally.save()
+        self.__tally_transfer(
+            owner, stage, STATUS.READY, stage, STATUS.WAITING, changed_count
+        )
         return changed_count
 
+    @property
+    def commander_id(self):
+        return self.__commander_id
+
+    def renew_claims(self):
+        """Keeps the hosts claimed by this commander from being reclaimed.
+        Returns the number of hosts renewed."""
+        return self.__db.HostDoc.renew_claims(self.__commander_id)
+
+    def reclaim_stale_hosts(self, timeout=None):
+        """Moves RUNNING hosts whose claims have not been renewed for timeout
+        seconds (default CLAIM_TIMEOUT) back to WAITING.  Returns the number
+        of hosts reclaimed."""
+        if timeout == None:
+            timeout = self.CLAIM_TIMEOUT
+        cutoff = util.utcnow() - datetime.timedelta(seconds=timeout)
+        hosts = self.__db.HostDoc.reclaim_stale(cutoff)
+        transfers = defaultdict(int)
+        for host in hosts:
+            self.__logger.warning(
+                "Reclaimed %s from %s"
+                % (host["ip"], host.get("claimed_by", "an unknown commander"))
+            )
+            transfers[(host["owner"], host["stage"])] += 1
+        for (owner, stage), count in transfers.items():
+            self.__tally_transfer(
+                owner, stage, STATUS.RUNNING, stage, STATUS.WAITING, count
+            )
+        return len(hosts)
+
+    def __maintain_claims(self):
+        """Renews this commander's claims and reclaims stale ones, at most
+        once every CLAIM_RENEW_INTERVAL seconds"""
+        now = time.time()
+        if (
+            self.__last_claim_maintenance != None
+            and now - self.__last_claim_maintenance < self.CLAIM_RENEW_INTERVAL
+        ):
+            return
+        self.__last_claim_maintenance = now
+        self.renew_claims()
+        self.reclaim_stale_hosts()
+
     def balance_ready_hosts(self):
         """Makes sure the correct number of hosts are in the READY state"""
+        self.__maintain_claims()
         limits = self.request_limits()
         for (owner, limit) in limits.items():
             tally = self.__db.TallyDoc.get_by_owner(owner)
@@ -152,15 +267,18 @@ class CHDatabase(object):
         hosts_modified_count = self.__db.HostDoc.reset_state_by_schedule()
         return hosts_modified_count
 
-    def tally_update(self, owner, prev_stage, prev_status, new_stage, new_status):
-        tally = self.__db.TallyDoc.get_by_owner(owner)
-        if tally == None:
+    def __tally_transfer(
+        self, owner, prev_stage, prev_status, new_stage, new_status, count
+    ):
+        if not self.__db.TallyDoc.transfer_atomically(
+            owner, prev_stage, prev_status, new_stage, new_status, count
+        ):
             self.__logger.warning(
                 "Tally document not found for: %s ... skipping." % owner
             )
-            return
-        tally.transfer(prev_stage, prev_status, new_stage, new_status, 1)
-        tally.save()
+
+    def tally_update(self, owner, prev_stage, prev_status, new_stage, new_status):
+        self.__tally_transfer(owner, prev_stage, prev_status, new_stage, new_status, 1)
 
     def update_host_priority_and_reschedule(self, ip):
         """Update host priority and reschedule host."""
@@ -202,6 +320,11 @@ class CHDatabase(object):
         # Calculating the state of a HostDoc is non-trivial.
         host.set_state(up, has_open_ports, reason)
 
+        # Only RUNNING hosts are claimed by a commander
+        if host["status"] != STATUS.RUNNING:
+            host.pop("claimed_by", None)
+            host.pop("claim_time", None)
+
         # If host finished a stage, update timestamp for latest_scan.<stage_that_just_finished>
         current_time = util.utcnow()
         if host_finished_stage:
@@ -273,15 +396,29 @@ class CHDatabase(object):
         self.__logger.debug('Updated %d "down" hosts.' % hosts_processed)
 
     def fetch_ready_hosts(self, count, stage, owner=None, waiting_too=False):
-        hosts = self.__db.HostDoc.get_some_for_stage(stage, count, owner, waiting_too)
-        # NOTE: there is a race condition here, but it won't occur with one commander.
-        # And the worst case scenario is that a host is scanned twice
-        # Used to be slow multiple find_and_update
+        """Claims up to count hosts of stage for this commander, moving them to
+        RUNNING.  Each host is claimed atomically, so any number of
+        commanders can fetch hosts concurrently.  Without an owner, only
+        hosts of the owners in this commander's partition are claimed.
+        Returns the claimed IPs."""
+        if owner == None:
+            owner = self.partition_owners()
+            if owner == []:
+                return []
         ips = []
-        for host in hosts:
-            int_ip = host["_id"]
-            self.transition_host(int_ip)
+        transfers = defaultdict(int)
+        while len(ips) < count:
+            host = self.__db.HostDoc.claim_for_stage(
+                stage, self.__commander_id, owner, waiting_too
+            )
+            if host == None:
+                break
+            transfers[(host["owner"], host["status"])] += 1
             ips.append(host["ip"])
+        for (host_owner, prev_status), transferred in transfers.items():
+            self.__tally_transfer(
+                host_owner, stage, prev_status, stage, STATUS.RUNNING, transferred
+            )
         return ips
 
     def get_open_ports(self, ip_list):
@@ -363,17 +500,17 @@ class CHDatabase(object):
                 closed_ticket_age[severity_name] = {"median": None, "max": None}
         return closed_ticket_age
 
-    def __get_tag_timespan(self, oid):
+    def __get_tag_timespan(self, oid, read_preference=None):
         """determines the earliest, and latest times of documents"""
         pipeline = queries.time_span(oid)
         r1 = database.run_pipeline_cursor(
-            (pipeline, database.HOST_SCAN_COLLECTION), self.__db
+            (pipeline, database.HOST_SCAN_COLLECTION), self.__db, read_preference
         )
         r2 = database.run_pipeline_cursor(
-            (pipeline, database.PORT_SCAN_COLLECTION), self.__db
+            (pipeline, database.PORT_SCAN_COLLECTION), self.__db, read_preference
         )
         r3 = database.run_pipeline_cursor(
-            (pipeline, database.VULN_SCAN_COLLECTION), self.__db
+            (pipeline, database.VULN_SCAN_COLLECTION), self.__db, read_preference
         )
         database.id_expand(r1)
         database.id_expand(r2)
@@ -394,10 +531,12 @@ class CHDatabase(object):
             end_time = max([i["end_time"] for i in spans])
             return start_time, end_time
 
-    def __get_host_timespan(self, owners):
+    def __get_host_timespan(self, owners, read_preference=None):
         """determines the earliest and latest last_changed times of hosts"""
         pipeline_collection = queries.host_time_span(owners)
-        results = database.run_pipeline_cursor(pipeline_collection, self.__db)
+        results = database.run_pipeline_cursor(
+            pipeline_collection, self.__db, read_preference
+        )
         database.id_expand(results)
 
         if len(results) == 0:
@@ -481,14 +620,24 @@ class CHDatabase(object):
         current_time = util.utcnow()
         snapshot_doc["last_change"] = current_time
 
+        # the documents were tagged before now, so read from secondaries only
+        # once they have replicated those writes
+        read_preference = database.secondary_read_preference(
+            self.__db,
+            self.SNAPSHOT_READ_PREFERENCE,
+            self.SNAPSHOT_MAX_STALENESS,
+            fresh_since=current_time,
+            wait=self.SNAPSHOT_REPLICATION_WAIT,
+        )
+
         start_time, end_time = self.__get_tag_timespan(
-            snapshot_oid
+            snapshot_oid, read_preference
         )  # Try to get start/end time from host_scan/port_scan/vuln_scan docs
         if (
             start_time == None
         ):  # If org has no latest=true host_scans, port_scans or vuln_scans, start_time will be None
             start_time, end_time = self.__get_host_timespan(
-                [owner] + descendants_included
+                [owner] + descendants_included, read_preference
             )  # Try to get start/end time from host docs (not ideal, but better than nothing)
             if (
                 start_time == None
@@ -512,13 +661,17 @@ class CHDatabase(object):
         pipeline_collection = queries.addresses_scanned_pl(
             [owner] + descendants_included
         )
-        results = database.run_pipeline_cursor(pipeline_collection, self.__db)
+        results = database.run_pipeline_cursor(
+            pipeline_collection, self.__db, read_preference
+        )
         if progress_callback:
             progress_callback()
         database.combine_results(snapshot_doc, results)
 
         pipeline_collection = queries.cvss_sum_pl(snapshot_oid)
-        results = database.run_pipeline_cursor(pipeline_collection, self.__db)
+        results = database.run_pipeline_cursor(
+            pipeline_collection, self.__db, read_preference
+        )
         if progress_callback:
             progress_callback()
         if results:
@@ -527,13 +680,17 @@ class CHDatabase(object):
             cvss_sum = 0.0
 
         pipeline_collection = queries.host_count_pl([owner] + descendants_included)
-        results = database.run_pipeline_cursor(pipeline_collection, self.__db)
+        results = database.run_pipeline_cursor(
+            pipeline_collection, self.__db, read_preference
+        )
         if progress_callback:
             progress_callback()
         database.combine_results(snapshot_doc, results)
 
         pipeline_collection = queries.vulnerable_host_count_pl(snapshot_oid)
-        results = database.run_pipeline_cursor(pipeline_collection, self.__db)
+        results = database.run_pipeline_cursor(
+            pipeline_collection, self.__db, read_preference
+        )
         if progress_callback:
             progress_callback()
         database.combine_results(snapshot_doc, results)
@@ -546,19 +703,25 @@ class CHDatabase(object):
         )
 
         pipeline_collection = queries.unique_operating_system_count_pl(snapshot_oid)
-        results = database.run_pipeline_cursor(pipeline_collection, self.__db)
+        results = database.run_pipeline_cursor(
+            pipeline_collection, self.__db, read_preference
+        )
         if progress_callback:
             progress_callback()
         database.combine_results(snapshot_doc, results)
 
         pipeline_collection = queries.port_count_pl(snapshot_oid)
-        results = database.run_pipeline_cursor(pipeline_collection, self.__db)
+        results = database.run_pipeline_cursor(
+            pipeline_collection, self.__db, read_preference
+        )
         if progress_callback:
             progress_callback()
         database.combine_results(snapshot_doc, results)
 
         pipeline_collection = queries.unique_port_count_pl(snapshot_oid)
-        results = database.run_pipeline_cursor(pipeline_collection, self.__db)
+        results = database.run_pipeline_cursor(
+            pipeline_collection, self.__db, read_preference
+        )
         if progress_callback:
             progress_callback()
         database.combine_results(snapshot_doc, results)
@@ -566,31 +729,41 @@ class CHDatabase(object):
         pipeline_collection = queries.silent_port_count_pl(
             [owner] + descendants_included
         )
-        results = database.run_pipeline_cursor(pipeline_collection, self.__db)
+        results = database.run_pipeline_cursor(
+            pipeline_collection, self.__db, read_preference
+        )
         if progress_callback:
             progress_callback()
         database.combine_results(snapshot_doc, results)
 
         pipeline_collection = queries.severity_count_pl(snapshot_oid)
-        results = database.run_pipeline_cursor(pipeline_collection, self.__db)
+        results = database.run_pipeline_cursor(
+            pipeline_collection, self.__db, read_preference
+        )
         if progress_callback:
             progress_callback()
         database.combine_results(snapshot_doc, results, "vulnerabilities")
 
         pipeline_collection = queries.unique_severity_count_pl(snapshot_oid)
-        results = database.run_pipeline_cursor(pipeline_collection, self.__db)
+        results = database.run_pipeline_cursor(
+            pipeline_collection, self.__db, read_preference
+        )
         if progress_callback:
             progress_callback()
         database.combine_results(snapshot_doc, results, "unique_vulnerabilities")
 
         pipeline_collection = queries.false_positives_pl(snapshot_oid)
-        results = database.run_pipeline_cursor(pipeline_collection, self.__db)
+        results = database.run_pipeline_cursor(
+            pipeline_collection, self.__db, read_preference
+        )
         if progress_callback:
             progress_callback()
         database.combine_results(snapshot_doc, results, "false_positives")
 
         pipeline_collection = queries.service_counts_simple_pl(snapshot_oid)
-        results = database.run_pipeline_cursor(pipeline_collection, self.__db)
+        results = database.run_pipeline_cursor(
+            pipeline_collection, self.__db, read_preference
+        )
         if progress_callback:
             progress_callback()
         services = self.__process_services(results)
@@ -599,7 +772,9 @@ class CHDatabase(object):
         pipeline_collection = queries.open_ticket_age_in_snapshot_pl(
             current_time, snapshot_oid
         )
-        results = database.run_pipeline_cursor(pipeline_collection, self.__db)
+        results = database.run_pipeline_cursor(
+            pipeline_collection, self.__db, read_preference
+        )
         if progress_callback:
             progress_callback()
         snapshot_doc["tix_msec_open"] = self.__process_open_ticket_age(
@@ -612,7 +787,9 @@ class CHDatabase(object):
         pipeline_collection = queries.closed_ticket_age_for_orgs_pl(
             tix_closed_since_date, [owner] + descendants_included
         )
-        results = database.run_pipeline_cursor(pipeline_collection, self.__db)
+        results = database.run_pipeline_cursor(
+            pipeline_collection, self.__db, read_preference
+        )
         if progress_callback:
             progress_callback()
         snapshot_doc["tix_msec_to_close"] = self.__process_closed_ticket_age(
@@ -641,8 +818,18 @@ class CHDatabase(object):
                 # NOTE: A descendant snapshot has a different parent id than itself
                 snaps_to_exclude_from_world_stats.append(snap["_id"])
 
+        # the world pipeline must see the snapshot saved above
+        read_preference = database.secondary_read_preference(
+            self.__db,
+            self.SNAPSHOT_READ_PREFERENCE,
+            self.SNAPSHOT_MAX_STALENESS,
+            fresh_since=util.utcnow(),
+            wait=self.SNAPSHOT_REPLICATION_WAIT,
+        )
         pipeline_collection = queries.world_pl(snaps_to_exclude_from_world_stats)
-        results = database.run_pipeline_cursor(pipeline_collection, self.__db)
+        results = database.run_pipeline_cursor(
+            pipeline_collection, self.__db, read_preference
+        )
         if progress_callback:
             progress_callback()
         database.combine_results(snapshot_doc, results, "world")
@@ -709,8 +896,17 @@ class CHDatabase(object):
 
         return owners_that_need_snapshot
 
-    def change_ownership(self, orig_owner, new_owner, networks, reason):
-        # Change owner on all relevant documents for a given list of networks.
+    def change_ownership(
+        self, orig_owner, new_owner, networks, reason, checkpoint_filename=None
+    ):
+        """Change owner on all relevant documents for a given IPSet of networks.
+        Adjacent CIDRs are merged into ranges and each collection is updated
+        in its own thread.  If checkpoint_filename is given, progress is
+        recorded there after every range so an interrupted change with the
+        same arguments resumes where it left off.  Only documents owned by
+        orig_owner are updated, so a resumed range never pushes a second
+        ticket CHANGED event.  The checkpoint is removed once all collections
+        are done."""
         # Special case for tickets collection; add a CHANGED event to the events list of each ticket
         change_event = {
             "time": util.utcnow(),
@@ -719,28 +915,88 @@ class CHDatabase(object):
             "reference": None,
             "delta": [{"from": orig_owner, "to": new_owner, "key": "owner"}],
         }
+        ranges = []
         for net in networks.iter_cidrs():
-            print "Changing owner of network %s to %s" % (net, new_owner)
-            for collection, ip_key, update_cmd in (
-                (self.__db.hosts, "_id", {"$set": {"owner": new_owner}}),
-                (self.__db.host_scans, "ip_int", {"$set": {"owner": new_owner}}),
-                (self.__db.port_scans, "ip_int", {"$set": {"owner": new_owner}}),
-                (self.__db.vuln_scans, "ip_int", {"$set": {"owner": new_owner}}),
-                (
-                    self.__db.tickets,
-                    "ip_int",
-                    {"$set": {"owner": new_owner}, "$push": {"events": change_event}},
-                ),
-            ):
+            if ranges and ranges[-1][1] + 1 == net.first:
+                ranges[-1][1] = net.last
+            else:
+                ranges.append([net.first, net.last])
+
+        checkpoint = {
+            "orig_owner": orig_owner,
+            "new_owner": new_owner,
+            "ranges": ranges,
+            "completed": {},  # {collection name: number of ranges done}
+        }
+        if checkpoint_filename and os.path.exists(checkpoint_filename):
+            with open(checkpoint_filename, "r") as f:
+                previous = json.load(f)
+            previous_job = (
+                previous["orig_owner"],
+                previous["new_owner"],
+                previous["ranges"],
+            )
+            if previous_job == (orig_owner, new_owner, ranges):
+                checkpoint = previous
+                print "Resuming owner change from %s" % checkpoint_filename
+            else:
+                print "Ignoring checkpoint for a different owner change in %s" % (
+                    checkpoint_filename
+                )
+        lock = threading.Lock()
+
+        def update_collection(update):
+            collection, ip_key, update_cmd = update
+            modified = 0
+            start = checkpoint["completed"].get(collection.name, 0)
+            for i in range(start, len(ranges)):
+                first, last = ranges[i]
+                # only documents still owned by orig_owner, so re-running a
+                # range interrupted part way through changes nothing twice
                 result = collection.update(
-                    {ip_key: {"$gte": net.first, "$lte": net.last}},
+                    {ip_key: {"$gte": first, "$lte": last}, "owner": orig_owner},
                     update_cmd,
                     upsert=False,
                     multi=True,
                     safe=True,
                 )
-                result["collection"] = collection.name
-                print "  {nModified} {collection} documents modified".format(**result)
+                modified += result["nModified"]
+                with lock:
+                    checkpoint["completed"][collection.name] = i + 1
+                    if checkpoint_filename:
+                        self.__write_checkpoint(checkpoint_filename, checkpoint)
+            with lock:
+                print "  %d %s documents modified" % (modified, collection.name)
+
+        print "Changing owner of %d network range(s) to %s" % (len(ranges), new_owner)
+        updates = (
+            (self.__db.hosts, "_id", {"$set": {"owner": new_owner}}),
+            (self.__db.host_scans, "ip_int", {"$set": {"owner": new_owner}}),
+            (self.__db.port_scans, "ip_int", {"$set": {"owner": new_owner}}),
+            (self.__db.vuln_scans, "ip_int", {"$set": {"owner": new_owner}}),
+            (
+                self.__db.tickets,
+                "ip_int",
+                {"$set": {"owner": new_owner}, "$push": {"events": change_event}},
+            ),
+        )
+        pool = ThreadPool(len(updates))
+        try:
+            pool.map(update_collection, updates)
+        finally:
+            pool.close()
+            pool.join()
+        if checkpoint_filename and os.path.exists(checkpoint_filename):
+            os.remove(checkpoint_filename)
+
+    def __write_checkpoint(self, filename, checkpoint):
+        # write to a temporary file first so a crash never leaves a partial checkpoint
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "w") as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_filename, filename)
 
     def pause_commander(self, sender, reason):
         """Request that the commander pause processing.
@@ -8,14 +8,31 @@ import Crypto.Random.random as random  # pip install pycrypto
 class CryptoKey(object):
     KEY_CHECK_HASH_BUMP = "xyzzy"
     SALT_SIZE = 32  # 256 bit
+    KEY_SIZE = 32  # 256 bit
+    # key derivation functions; store kdf alongside (salt, rounds, key_check)
+    KDF_SHA256_STRETCH = "sha256-stretch"  # original salted sha256 loop
+    KDF_PBKDF2_SHA256 = "pbkdf2-sha256"
+    KDFS = (KDF_SHA256_STRETCH, KDF_PBKDF2_SHA256)
+    PBKDF2_CALIBRATION_ROUNDS = 10000
+    # {(kdf, salt, rounds): {password fingerprint: (key, key_check)}}
+    __derived_keys = {}
 
     def __init__(
-        self, password, salt=None, rounds=None, key_check=None, computation_time=1.0
+        self,
+        password,
+        salt=None,
+        rounds=None,
+        key_check=None,
+        computation_time=1.0,
+        kdf=KDF_SHA256_STRETCH,
     ):
+        if kdf not in CryptoKey.KDFS:
+            raise ValueError("Unknown key derivation function: %s" % kdf)
         self.salt = salt
         self.rounds = rounds
         self.key_check = key_check
         self.computation_time = computation_time
+        self.kdf = kdf
         self.key = None
         if salt == None:
             self.__generate_key(password)
@@ -24,9 +41,26 @@ class CryptoKey(object):
             if not key_check_passed:
                 raise Exception("Wrong password: key check mismatch")
 
+    def __fingerprint(self, password):
+        # only kept in memory, to tell passwords apart in the derived key cache
+        return hashlib.sha256(self.salt + password).digest()
+
+    def __cache_key(self, password, key, key_check):
+        cache = CryptoKey.__derived_keys.setdefault(
+            (self.kdf, self.salt, self.rounds), {}
+        )
+        cache[self.__fingerprint(password)] = (key, key_check)
+
     def __generate_key(self, password):
         """Generates a key from a password using salting and stretching"""
         salt = "".join(chr(random.randint(0, 0xFF)) for i in range(CryptoKey.SALT_SIZE))
+        if self.kdf == CryptoKey.KDF_PBKDF2_SHA256:
+            self.salt = salt
+            self.rounds = self.__calibrate_pbkdf2(password)
+            self.key, self.key_check = self.__derive_pbkdf2(password)
+            self.__cache_key(password, self.key, self.key_check)
+            return
+
         start_time = time.time()
         end_time = start_time + self.computation_time
         x = hashlib.sha256(password + salt)
@@ -42,31 +76,80 @@ class CryptoKey(object):
         self.key_check = hashlib.sha256(
             CryptoKey.KEY_CHECK_HASH_BUMP + next_to_last_x.digest() + password + salt
         ).digest()
+        self.__cache_key(password, self.key, self.key_check)
+
+    def __calibrate_pbkdf2(self, password):
+        """Returns the number of PBKDF2 rounds that take computation_time"""
+        start_time = time.time()
+        hashlib.pbkdf2_hmac(
+            "sha256",
+            password,
+            self.salt,
+            CryptoKey.PBKDF2_CALIBRATION_ROUNDS,
+            CryptoKey.KEY_SIZE,
+        )
+        elapsed = max(time.time() - start_time, 1e-6)
+        return max(
+            1,
+            int(CryptoKey.PBKDF2_CALIBRATION_ROUNDS * self.computation_time / elapsed),
+        )
+
+    def __derive_pbkdf2(self, password):
+        key = hashlib.pbkdf2_hmac(
+            "sha256", password, self.salt, self.rounds, CryptoKey.KEY_SIZE
+        )
+        key_check = hashlib.sha256(
+            CryptoKey.KEY_CHECK_HASH_BUMP + key + self.salt
+        ).digest()
+        return key, key_check
 
     def __verify_key(self, password):
+        cached = CryptoKey.__derived_keys.get((self.kdf, self.salt, self.rounds), {})
+        key_and_check = cached.get(self.__fingerprint(password))
+        if key_and_check:
+            key, key_check = key_and_check
+            # key_check is None when there were too few rounds to compute one
+            if self.key_check and key_check and key_check != self.key_check:
+                return False
+            self.key = key
+            return True
+
+        if self.kdf == CryptoKey.KDF_PBKDF2_SHA256:
+            key, key_check = self.__derive_pbkdf2(password)
+            if self.key_check and key_check != self.key_check:
+                return False
+            self.key = key
+            self.__cache_key(password, key, key_check)
+            return True
+
         x = hashlib.sha256(password + self.salt)
         r = 0
+        key_check = None
         while r < self.rounds:
             r += 1
             x = hashlib.sha256(x.digest() + password + self.salt)
-            if r == self.rounds - 1 and self.key_check:
+            if r == self.rounds - 1:
                 key_check = hashlib.sha256(
                     CryptoKey.KEY_CHECK_HASH_BUMP + x.digest() + password + self.salt
                 ).digest()
-                if key_check != self.key_check:
+                if self.key_check and key_check != self.key_check:
                     return False
         self.key = x.digest()
+        self.__cache_key(password, self.key, key_check)
         return True
 
 
+import binascii
+from collections import defaultdict
+
 import netaddr
-import netaddr.strategy
-import struct
+import numpy as np
 from Crypto.Cipher import AES
 
 
 class IPCoder(object):
-    """docstring for IPCoder"""
+    """Encrypts and decrypts IP addresses with AES-CBC.  Every address is
+    its own CBC message starting from the same iv."""
 
     BLOCK_SIZE = 16
     PADDING = " "
@@ -79,18 +162,60 @@ class IPCoder(object):
         super(IPCoder, self).__init__()
         self.key = key
         self.iv = iv
+        # CBC is applied by hand over ECB so one cipher serves every address
+        self.__ecb = AES.new(key, AES.MODE_ECB)
+        self.__iv_block = np.frombuffer(str(iv), dtype=np.uint8)
+
+    def __ip_ints(self, ips, version):
+        """Returns the addresses as integers (or the array as given) and
+        their IP version.  The version defaults to that of the
+        netaddr.IPAddresses, or 4 for integers.  Raises ValueError if the
+        addresses have mixed versions or are out of range for the version."""
+        if isinstance(ips, np.ndarray):
+            ip_ints = ips
+        else:
+            ips = list(ips)
+            versions = set(
+                ip.version for ip in ips if isinstance(ip, netaddr.IPAddress)
+            )
+            if version == None:
+                if len(versions) > 1:
+                    raise ValueError("Cannot encrypt IPv4 and IPv6 together")
+                version = versions.pop() if versions else 4
+            elif versions - set([version]):
+                raise ValueError(
+                    "Cannot encrypt IPv%d addresses as IPv%d"
+                    % (max(versions - set([version])), version)
+                )
+            ip_ints = [int(ip) for ip in ips]
+        if version == None:
+            version = 4
+        if version not in (4, 6):
+            raise ValueError("Unknown IP version: %s" % version)
+        if len(ip_ints):
+            bits = 32 if version == 4 else 128
+            if isinstance(ip_ints, np.ndarray):
+                low, high = int(ip_ints.min()), int(ip_ints.max())
+            else:
+                low, high = min(ip_ints), max(ip_ints)
+            if low < 0 or high >> bits:
+                raise ValueError(
+                    "Address %d is out of range for IPv%d"
+                    % (low if low < 0 else high, version)
+                )
+        return ip_ints, version
 
-    def __pack_ip(self, ip):
-        ip_int = int(ip)
-        word_count = ip._module.width / 8
-        words = netaddr.strategy.int_to_words(ip_int, 8, word_count)
-        packed = struct.pack(">" + "B" * len(words), *words)
-        return packed
+    def __pack_ips(self, ip_ints, width):
+        """Returns an (n, width) uint8 array of big-endian packed addresses"""
+        if width == 4:
+            ip_ints = np.asarray(ip_ints, dtype=">u4")
+            return ip_ints.view(np.uint8).reshape(len(ip_ints), width)
+        packed = "".join(binascii.unhexlify("%032x" % int(ip)) for ip in ip_ints)
+        return np.frombuffer(packed, dtype=np.uint8).reshape(-1, width)
 
     def __unpack_ip(self, packed):
         n = len(packed)
-        words = struct.unpack(">" + "B" * n, packed)
-        ip_int = netaddr.strategy.words_to_int(words, 8, n)
+        ip_int = int(binascii.hexlify(packed) or "0", 16)
         # explicity provide IP version to prevent ::1 from becoming 0.0.0.1
         if n == 4:
             version = 4
@@ -100,18 +225,73 @@ class IPCoder(object):
             version = None
         return netaddr.IPAddress(ip_int, version)
 
+    def encrypt_many(self, ips, version=None):
+        """Encrypts an iterable or array of addresses of one IP version, given
+        as integers or netaddr.IPAddresses.  The version defaults to that of
+        the netaddr.IPAddresses, or 4 for integers and arrays.  Raises
+        ValueError for addresses out of range for the version.  All blocks
+        are processed as one buffer.  Returns a list of cyphertexts identical
+        to calling encrypt() on each address."""
+        ip_ints, version = self.__ip_ints(ips, version)
+        width = 4 if version == 4 else 16
+        packed = self.__pack_ips(ip_ints, width)
+        n = len(packed)
+        if n == 0:
+            return []
+        padded_width = len(self.pad(" " * width))
+        plaintext = np.empty((n, padded_width), dtype=np.uint8)
+        plaintext.fill(ord(IPCoder.PADDING))
+        plaintext[:, :width] = packed
+        cyphertext = np.empty_like(plaintext)
+        previous = self.__iv_block
+        for start in range(0, padded_width, IPCoder.BLOCK_SIZE):
+            end = start + IPCoder.BLOCK_SIZE
+            chained = np.bitwise_xor(plaintext[:, start:end], previous)
+            encrypted = self.__ecb.encrypt(chained.tobytes())
+            cyphertext[:, start:end] = np.frombuffer(encrypted, dtype=np.uint8).reshape(
+                n, IPCoder.BLOCK_SIZE
+            )
+            previous = cyphertext[:, start:end]
+        return [row.tobytes() for row in cyphertext]
+
+    def decrypt_many(self, cyphertexts):
+        """Decrypts a sequence of cyphertexts produced by encrypt() or
+        encrypt_many().  Cyphertexts of the same length are processed as one
+        buffer.  Returns a list of netaddr.IPAddresses in the same order."""
+        results = [None] * len(cyphertexts)
+        by_length = defaultdict(list)
+        for i, cyphertext in enumerate(cyphertexts):
+            by_length[len(cyphertext)].append(i)
+        for length, indices in by_length.items():
+            n = len(indices)
+            buf = "".join(str(cyphertexts[i]) for i in indices)
+            cyphertext = np.frombuffer(buf, dtype=np.uint8).reshape(n, length)
+            decrypted = np.frombuffer(self.__ecb.decrypt(buf), dtype=np.uint8)
+            chain = np.empty_like(cyphertext)
+            chain[:, : IPCoder.BLOCK_SIZE] = self.__iv_block
+            chain[:, IPCoder.BLOCK_SIZE :] = cyphertext[:, : -IPCoder.BLOCK_SIZE]
+            plaintext = np.bitwise_xor(decrypted.reshape(n, length), chain)
+            # the cyphertext length gives the packed width, so addresses
+            # ending in a PADDING byte are not truncated by rstrip()
+            width = {16: 4, 32: 16}.get(length)
+            if width == 4:
+                ip_ints = np.ascontiguousarray(plaintext[:, :4]).view(">u4").ravel()
+                for i, ip_int in zip(indices, ip_ints.tolist()):
+                    results[i] = netaddr.IPAddress(ip_int, 4)
+                continue
+            for i, row in zip(indices, plaintext):
+                if width:
+                    results[i] = self.__unpack_ip(row[:width].tobytes())
+                else:
+                    results[i] = self.__unpack_ip(
+                        row.tobytes().rstrip(IPCoder.PADDING)
+                    )
+        return results
+
     def encrypt(self, ip):
-        """docstring for encrypt"""
-        encryptor = AES.new(self.key, AES.MODE_CBC, self.iv)
-        plaintext = self.__pack_ip(ip)
-        plaintext = self.pad(plaintext)
-        cyphertext = encryptor.encrypt(plaintext)
-        return cyphertext
+        """Encrypts a single netaddr.IPAddress"""
+        return self.encrypt_many([ip], ip.version)[0]
 
     def decrypt(self, cyphertext):
-        """docstring for decrypt"""
-        decryptor = AES.new(self.key, AES.MODE_CBC, self.iv)
-        plaintext = decryptor.decrypt(cyphertext)
-        plaintext = plaintext.rstrip(IPCoder.PADDING)
-        ip_int = self.__unpack_ip(plaintext)
-        return netaddr.IPAddress(ip_int)
+        """Decrypts a single cyphertext into a netaddr.IPAddress"""
+        return self.decrypt_many([cyphertext])[0]
@@ -1,22 +1,38 @@
-__all__ = ["db_from_connection", "db_from_config", "id_expand", "ensure_indices"]
+__all__ = [
+    "db_from_connection",
+    "db_from_config",
+    "set_client_options",
+    "close_clients",
+    "secondary_read_preference",
+    "id_expand",
+    "ensure_indices",
+    "RequestRollbackError",
+]
 
 from collections import defaultdict, Iterable, OrderedDict
 import copy
 import datetime
+import hashlib
+import json
+import os
 import random
 import re
 import sys
+import threading
 import time
 
 from bson import ObjectId
 from bson.binary import Binary
 from mongokit import Document, MongoClient, CustomType
 import netaddr
-from pymongo.errors import OperationFailure
+from pymongo import GEOSPHERE, ReadPreference
+from pymongo.errors import OperationFailure, PyMongoError
 
 from cyhy.core.common import *
 from cyhy.core.config import Config
 from cyhy.core.yaml_config import YamlConfig
+from cyhy.db.network_index import NetworkIndex
+from cyhy.db.org_graph import OrgGraph
 from cyhy.util import util
 
 CVE_COLLECTION = "cves"
@@ -38,9 +54,68 @@ VULN_SCAN_COLLECTION = "vuln_scans"
 
 CONTROL_DOC_POLL_INTERVAL = 5  # seconds
 
-
-def db_from_connection(uri, name):
-    con = MongoClient(host=uri, tz_aware=True)
+# replSetGetStatus member states
+REPLSET_PRIMARY = 1
+REPLSET_SECONDARY = 2
+REPLSET_POLL_INTERVAL = 0.5  # seconds
+
+# MongoClient options used by db_from_connection().  Options given in the
+# URI (e.g. ?maxPoolSize=50&readPreference=secondaryPreferred) take
+# precedence over these.
+CLIENT_OPTIONS = {
+    "max_pool_size": 100,
+    "connectTimeoutMS": 20000,
+    "socketTimeoutMS": None,
+    "waitQueueTimeoutMS": None,
+    "read_preference": ReadPreference.PRIMARY,
+}
+
+# process-wide MongoClients: {(uri, options): MongoClient}
+_clients = dict()
+_clients_lock = threading.Lock()
+_clients_pid = os.getpid()
+
+
+def set_client_options(**options):
+    """Updates the MongoClient options used for new connections, e.g.
+    set_client_options(max_pool_size=10, socketTimeoutMS=60000)"""
+    unknown = set(options) - set(CLIENT_OPTIONS)
+    if unknown:
+        raise ValueError("Unknown client options: %s" % ", ".join(sorted(unknown)))
+    CLIENT_OPTIONS.update(options)
+
+
+def close_clients():
+    """Disconnects and forgets every shared MongoClient of this process"""
+    global _clients_pid
+    with _clients_lock:
+        if _clients_pid == os.getpid():
+            for con in _clients.values():
+                con.close()
+        _clients.clear()
+        _clients_pid = os.getpid()
+
+
+def _shared_client(uri, options):
+    """Returns the MongoClient shared by this process for uri and options,
+    creating it on first use.  Clients inherited from a parent process are
+    discarded (not closed, their sockets belong to the parent) so that each
+    forked worker makes its own connections."""
+    global _clients_pid
+    key = (uri, tuple(sorted(options.items())))
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+        con = _clients.get(key)
+        if con is None:
+            con = _new_client(uri, options)
+            _clients[key] = con
+        return con
+
+
+def _new_client(uri, options):
+    con = MongoClient(host=uri, tz_aware=True, **options)
     con.register(
         [
             CVEDoc,
@@ -61,6 +136,23 @@ def db_from_connection(uri, name):
             VulnScanDoc,
         ]
     )
+    return con
+
+
+class RequestRollbackError(Exception):
+    """Raised by RequestDoc.save_many when a bulk write failed and the
+    previous requests could not be restored, so some may have been written"""
+
+    pass
+
+
+def db_from_connection(uri, name, **client_options):
+    """Returns the database name, using a MongoClient that is shared by every
+    call in this process with the same uri and client options.
+    client_options override CLIENT_OPTIONS for this connection."""
+    options = dict(CLIENT_OPTIONS)
+    options.update(client_options)
+    con = _shared_client(uri, options)
     db = con[name]
     return db
 
@@ -104,11 +196,71 @@ def combine_results(d, results, envelope=None):
     d.update(the_goods)
 
 
-def run_pipeline((pipeline, collection), db):
+def secondary_read_preference(
+    db, read_preference, max_staleness=None, fresh_since=None, wait=0
+):
+    """Returns read_preference if the healthy secondaries are at most
+    max_staleness seconds behind the primary and have replicated every write
+    the primary made before the datetime fresh_since, waiting up to wait
+    seconds for them to catch up.  Otherwise, or if the replica set status is
+    unavailable, returns ReadPreference.PRIMARY.  pymongo 2.x does not
+    support maxStalenessSeconds, so it is emulated with replSetGetStatus."""
+    if read_preference == ReadPreference.PRIMARY or (
+        max_staleness is None and fresh_since is None
+    ):
+        return read_preference
+    deadline = time.time() + wait
+    while True:
+        try:
+            status = db.connection.admin.command("replSetGetStatus")
+        except OperationFailure:
+            return ReadPreference.PRIMARY
+        members = status.get("members", [])
+        primary = [
+            m["optimeDate"] for m in members if m.get("state") == REPLSET_PRIMARY
+        ]
+        secondaries = [
+            m["optimeDate"]
+            for m in members
+            if m.get("state") == REPLSET_SECONDARY and m.get("health") == 1
+        ]
+        if not primary or not secondaries:
+            return ReadPreference.PRIMARY
+        required = primary[0]
+        if fresh_since is None:
+            required = primary[0] - datetime.timedelta(seconds=max_staleness)
+        elif max_staleness is None:
+            required = min(primary[0], fresh_since)
+        else:
+            required = max(
+                primary[0] - datetime.timedelta(seconds=max_staleness),
+                min(primary[0], fresh_since),
+            )
+        if min(secondaries) >= required:
+            return read_preference
+        if time.time() >= deadline:
+            return ReadPreference.PRIMARY
+        time.sleep(REPLSET_POLL_INTERVAL)
+
+
+def _pipeline_collection(db, collection, read_preference, max_staleness):
+    if read_preference is None:
+        return db[collection]
+    read_preference = secondary_read_preference(db, read_preference, max_staleness)
+    return db.get_collection(collection, read_preference=read_preference)
+
+
+def run_pipeline(
+    (pipeline, collection), db, read_preference=None, max_staleness=None
+):
     """Run an aggregation using a pipeline, collection tuple like those provided
-       in the queries module."""
+       in the queries module.  read_preference (e.g.
+       ReadPreference.SECONDARY_PREFERRED) overrides the connection's read
+       preference; with max_staleness the primary is used instead if the
+       secondaries are more than max_staleness seconds behind it."""
+    collection = _pipeline_collection(db, collection, read_preference, max_staleness)
     try:
-        results = db[collection].aggregate(pipeline, allowDiskUse=True)
+        results = collection.aggregate(pipeline, allowDiskUse=True)
     except OperationFailure, e:
         if e.details["code"] == 16389:
             e.args += (
@@ -118,10 +270,13 @@ def run_pipeline((pipeline, collection), db):
     return results["result"]
 
 
-def run_pipeline_cursor((pipeline, collection), db):
+def run_pipeline_cursor(
+    (pipeline, collection), db, read_preference=None, max_staleness=None
+):
     """Like run_pipeline but uses a cursor to access results larger than the max
        MongoDB size."""
-    cursor = db[collection].aggregate(pipeline, allowDiskUse=True, cursor={})
+    collection = _pipeline_collection(db, collection, read_preference, max_staleness)
+    cursor = collection.aggregate(pipeline, allowDiskUse=True, cursor={})
     results = []
     for doc in cursor:
         results.append(doc)
@@ -207,6 +362,34 @@ class RootDoc(Document):
         pass
 
 
+class ContentHashedDoc(RootDoc):
+    """A document that stores a hash of its content, so that syncs from
+    external feeds can skip writing documents that have not changed."""
+
+    structure = {"content_hash": basestring}
+
+    @staticmethod
+    def content_hash_of(doc):
+        """Returns the content hash of a document (or dict), ignoring its _id
+        and content_hash"""
+        content = dict(
+            (k, v) for k, v in doc.iteritems() if k not in ("_id", "content_hash")
+        )
+        return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+    def content_hashes(self):
+        """Returns a dict of {_id: content_hash} for the whole collection,
+        read in a single projected scan"""
+        return dict(
+            (doc["_id"], doc.get("content_hash"))
+            for doc in self.collection.find({}, {"content_hash": True})
+        )
+
+    def save(self, *args, **kwargs):
+        self["content_hash"] = self.content_hash_of(self)
+        super(ContentHashedDoc, self).save(*args, **kwargs)
+
+
 class ScorecardDoc(RootDoc):
     __collection__ = SCORECARD_COLLECTION
     structure = {
@@ -472,6 +655,7 @@ class TicketDoc(RootDoc):
             ),
             ("ip_open", [("ip_int", 1), ("open", 1)], False, False),
             ("open_owner", [("open", 1), ("owner", 1)], False, False),
+            ("details_cve_open", [("details.cve", 1), ("open", 1)], False, False),
             ("time_opened", [("time_opened", 1), ("open", 1)], False, False),
             ("last_change", [("last_change", 1)], False, False),
             ("time_closed", [("time_closed", 1)], False, True),
@@ -776,6 +960,8 @@ class HostDoc(RootDoc):
         "loc": (float, float),
         "priority": int,
         "r": float,
+        "claimed_by": basestring,  # ID of the commander scanning a RUNNING host
+        "claim_time": datetime.datetime,
         "latest_scan": {
             STAGE.NETSCAN1: datetime.datetime,
             STAGE.NETSCAN2: datetime.datetime,
@@ -834,6 +1020,8 @@ class HostDoc(RootDoc):
                 False,
             ),
             ("ip", [("ip", 1)], False, False),
+            ("claimed_by", [("claimed_by", 1), ("status", 1)], False, True),
+            ("claim_time", [("status", 1), ("claim_time", 1)], False, False),
             ("up", [("state.up", 1), ("owner", 1)], False, False),
             (
                 "next_scan",
@@ -880,6 +1068,67 @@ class HostDoc(RootDoc):
         self["loc"] = location
         self["stage"] = stage
 
+    def init_many(
+        self, ips, owner, stage, geo_loc_db, chunk_size=10000, progress_callback=None
+    ):
+        """Creates host documents for every address in the ips IPSet.
+        Equivalent to calling init() and save() on a new HostDoc for each
+        address, but the documents are written in chunks of unordered bulk
+        upserts instead of one validated save per host.
+        progress_callback is called with the running count of hosts written
+        after each chunk.  Returns the number of hosts written."""
+        # same defaults as a new HostDoc; callables (e.g. r) are called per host
+        static_defaults = dict(
+            (k, v) for k, v in self.default_values.items() if not callable(v)
+        )
+        callable_defaults = [
+            (k, v) for k, v in self.default_values.items() if callable(v)
+        ]
+        written = 0
+        chunk = []
+        for net in ips.iter_cidrs():
+            version = net.version
+            for ip_int in xrange(net.first, net.last + 1):
+                ip = netaddr.IPAddress(ip_int, version)
+                location = geo_loc_db.lookup(ip)
+                try:  # same coercion as save()
+                    location = [float(location[0]), float(location[1])]
+                except TypeError:
+                    location = list(location)
+                doc = copy.deepcopy(static_defaults)
+                for key, default in callable_defaults:
+                    doc[key] = default()
+                doc.update(
+                    {
+                        "_id": long(ip_int),
+                        "ip": str(ip),
+                        "owner": owner,
+                        "loc": location,
+                        "stage": stage,
+                    }
+                )
+                chunk.append(doc)
+                if len(chunk) >= chunk_size:
+                    written += self.__write_init_chunk(chunk)
+                    chunk = []
+                    if progress_callback:
+                        progress_callback(written)
+        if chunk:
+            written += self.__write_init_chunk(chunk)
+            if progress_callback:
+                progress_callback(written)
+        return written
+
+    def __write_init_chunk(self, chunk):
+        now = util.utcnow()
+        bulk = self.collection.initialize_unordered_bulk_op()
+        for doc in chunk:
+            doc["last_change"] = now
+            # upsert to keep the replace semantics of save()
+            bulk.find({"_id": doc["_id"]}).upsert().replace_one(doc)
+        bulk.execute()
+        return len(chunk)
+
     def get_count(self, owner, stage, status):
         count = self.find({"stage": stage, "status": status, "owner": owner}).count()
         return count
@@ -1005,11 +1254,80 @@ class HostDoc(RootDoc):
         ).limit(limit)
         return cursor
 
+    def claim_for_stage(self, stage, commander, owner=None, waiting=False):
+        """Atomically marks the next READY host of stage (or WAITING host if
+        waiting is True) as RUNNING and claimed by commander.  owner may be
+        a single owner or a list of owners.  Concurrent commanders can never
+        claim the same host.  Returns the host as it was before it was
+        claimed, or None if there are no hosts to claim."""
+        if waiting:
+            status = {"$in": [STATUS.READY, STATUS.WAITING]}
+        else:
+            status = STATUS.READY
+        spec = {"status": status, "stage": stage}
+        if isinstance(owner, list):
+            spec["owner"] = {"$in": owner}
+        elif owner != None:
+            spec["owner"] = owner
+        now = util.utcnow()
+        return self.find_and_modify(
+            query=spec,
+            update={
+                "$set": {
+                    "status": STATUS.RUNNING,
+                    "claimed_by": commander,
+                    "claim_time": now,
+                    "last_change": now,
+                }
+            },
+            sort=[("priority", 1), ("r", 1)],
+            fields={"ip": True, "owner": True, "stage": True, "status": True},
+        )
+
+    def renew_claims(self, commander):
+        """Refreshes the claim time of the RUNNING hosts claimed by commander
+        so that they are not reclaimed.  Returns the number of hosts."""
+        result = self.collection.update(
+            spec={"claimed_by": commander, "status": STATUS.RUNNING},
+            document={"$set": {"claim_time": util.utcnow()}},
+            multi=True,
+        )
+        return result["n"]
+
+    def reclaim_stale(self, cutoff):
+        """Moves RUNNING hosts whose claim was last renewed before the
+        datetime cutoff (or that were never claimed and last changed before
+        cutoff) back to WAITING, one atomic update at a time.  Returns the
+        reclaimed hosts as they were before they were reclaimed."""
+        spec = {
+            "status": STATUS.RUNNING,
+            "$or": [
+                {"claim_time": {"$lt": cutoff}},
+                {"claim_time": {"$exists": False}, "last_change": {"$lt": cutoff}},
+            ],
+        }
+        reclaimed = []
+        while True:
+            host = self.find_and_modify(
+                query=spec,
+                update={
+                    "$set": {"status": STATUS.WAITING, "last_change": util.utcnow()},
+                    "$unset": {"claimed_by": True, "claim_time": True},
+                },
+                fields={"ip": True, "owner": True, "stage": True, "claimed_by": True},
+            )
+            if host is None:
+                return reclaimed
+            reclaimed.append(host)
+
     def purge_all_running(self):
         now = util.utcnow()
         self.collection.update(
             spec={"status": STATUS.RUNNING},
-            document={"$set": {"status": STATUS.WAITING, "last_change": now}},
+            document={
+                "$set": {"status": STATUS.WAITING, "last_change": now},
+                "$unset": {"claimed_by": True, "claim_time": True},
+            },
             multi=True,
         )
 
@@ -1035,6 +1353,15 @@ class RequestDoc(RootDoc):
     # This regex was taken from the Python example at
     # https://emailregex.com/
     __EmailAddressRegex = re.compile(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)")
+    # cached structures built from all requests are rebuilt once they are
+    # CACHE_TTL seconds old, picking up changes made by other processes
+    CACHE_TTL = 60  # seconds
+    # {collection full name: (time built, NetworkIndex)} shared by all
+    # instances in a process
+    __network_indices = {}
+    # {collection full name: (time built, OrgGraph)} shared by all instances
+    # in a process
+    __org_graphs = {}
     structure = {
         "agency": {
             "name": basestring,
@@ -1131,16 +1458,50 @@ class RequestDoc(RootDoc):
 
         return parents
 
+    def __cached(self, cache, refresh=False):
+        """Returns this collection's value in cache, or None if there is none,
+        it is older than CACHE_TTL seconds, or refresh is True"""
+        entry = cache.get(self.collection.full_name)
+        if entry is None or refresh or time.time() - entry[0] >= self.CACHE_TTL:
+            return None
+        return entry[1]
+
+    def __cache(self, cache, value):
+        cache[self.collection.full_name] = (time.time(), value)
+        return value
+
+    def get_network_index(self, refresh=False):
+        """Returns the cached NetworkIndex of every request's networks,
+        building it on first use, when it is older than CACHE_TTL seconds, or
+        when refresh is True.  The index is patched whenever a request is
+        saved or deleted in this process."""
+        index = self.__cached(self.__network_indices, refresh)
+        if index is None:
+            index = self.__cache(
+                self.__network_indices,
+                NetworkIndex(
+                    (r["_id"], r.get("networks", []))
+                    for r in self.collection.find(
+                        {"networks": {"$ne": []}}, {"networks": True}
+                    )
+                ),
+            )
+        return index
+
+    def resolve_owners(self, ip_ints):
+        """Returns a NumPy array of the owners of integer IPv4 addresses,
+        resolved in memory from the network index.  Unowned addresses
+        resolve to UNKNOWN_OWNER."""
+        return self.get_network_index().resolve_owners(ip_ints)
+
     def get_all_intersections(self, cidrs):
         results = OrderedDict()  # {request: IPSet of intersections}
-        all_requests = self.collection.aggregate(
-            [{"$match": {"networks": {"$ne": []}}}, {"$sort": {"_id": 1}}], cursor={}
-        )
-        for request in all_requests:
-            intersection = netaddr.IPSet(request["networks"]) & cidrs
-            if intersection:
-                request_doc = self.find_one({"_id": request["_id"]})
-                results[request_doc] = intersection
+        intersections = self.get_network_index().intersections(cidrs)
+        if intersections:
+            for request_doc in self.find(
+                spec={"_id": {"$in": intersections.keys()}}, sort=[("_id", 1)]
+            ):
+                results[request_doc] = intersections[request_doc["_id"]]
         return results
 
     def add_children(self, db, child_ids):
@@ -1166,6 +1527,7 @@ class RequestDoc(RootDoc):
         if not self.get("children"):
             self["children"] = []
         self["children"] += child_ids
+        self.invalidate_org_graph()
         return True
 
     def remove_children(self, child_ids):
@@ -1181,87 +1543,60 @@ class RequestDoc(RootDoc):
                     + self["_id"]
                 )
         self["children"] = list(set(self["children"]) - set(child_ids))
+        self.invalidate_org_graph()
         return True
 
+    def get_org_graph(self, refresh=False):
+        """Returns the cached OrgGraph of all requests, building it from one
+        projected read on first use, when it is older than CACHE_TTL seconds,
+        or when refresh is True.  The graph is dropped whenever children
+        change or a request is saved or deleted in this process."""
+        graph = self.__cached(self.__org_graphs, refresh)
+        if graph is None:
+            graph = self.__cache(
+                self.__org_graphs,
+                OrgGraph(
+                    self.collection.find(
+                        {},
+                        {
+                            "_id": True,
+                            "children": True,
+                            "stakeholder": True,
+                            "retired": True,
+                        },
+                    )
+                ),
+            )
+        return graph
+
+    def invalidate_org_graph(self):
+        self.__org_graphs.pop(self.collection.full_name, None)
+
     def get_all_descendants(
         self, owner, stakeholders_only=False, include_retired=False
     ):
-        # Build dict of every org and its children (if any)
-        org_info = dict()
-        for org in self.find():
-            org_info[org["_id"]] = {
-                "children": org.get("children", []),
-                "stakeholder": org.get("stakeholder", False),
-                "retired": org.get("retired", False),
-            }
-
-        if not org_info.get(owner):
-            raise ValueError(owner + " has no request document")
-
-        def get_descendants(org_info, current_org, stakeholders_only, include_retired):
-            # Recursive function to get descendants of current_org
-            descendants = set()
-            for child_org in org_info.get(current_org, {}).get("children", []):
-                if include_retired or not org_info[child_org].get("retired"):
-                    if not stakeholders_only or org_info[child_org].get("stakeholder"):
-                        descendants.add(child_org)
-                    descendants = descendants.union(
-                        get_descendants(
-                            org_info, child_org, stakeholders_only, include_retired
-                        )
-                    )
-            return descendants
-
-        # Build descendants set
-        descendants = set()
-        descendants = descendants.union(
-            get_descendants(org_info, owner, stakeholders_only, include_retired)
+        return list(
+            self.get_org_graph().descendants(
+                owner,
+                stakeholders_only=stakeholders_only,
+                include_retired=include_retired,
+            )
         )
-        return list(descendants)
 
     def get_owner_to_type_dict(self, stakeholders_only=False, include_retired=False):
         """returns a dict of owner_id:type. "stakeholders_only" parameter eliminates non-stakeholders from the dict."""
+        # Orgs that fall into multiple types are deconflicted by the graph.
+        # This can occur under normal circumstances when using the
+        # CYHY_THIRD_PARTY report type (see CYHYDEV-789).  This can also occur
+        # if an organization has erroneously been added as a descendant of
+        # more than one AGENCY_TYPE (FEDERAL, STATE, etc.) node; those orgs
+        # get a type joining all matching types (or "UNKNOWN") so that a
+        # human can correct the situation.
+        graph = self.get_org_graph()
         types = defaultdict(lambda: list())
-        for agency_type in AGENCY_TYPE:
-            all_agency_type_descendants = self.get_all_descendants(
-                agency_type, include_retired=include_retired
-            )
-            for org in self.find({"_id": {"$in": all_agency_type_descendants}}):
-                if not stakeholders_only or org["stakeholder"]:
-                    types[org["_id"]].append(agency_type)
-
-        # Check for any orgs that fall into multiple types.  This can occur
-        # under normal circumstances when using the CYHY_THIRD_PARTY report
-        # type (see CYHYDEV-789).  This can also occur if an organization
-        # has erroneously been added as a descendant of more than one
-        # AGENCY_TYPE (FEDERAL, STATE, etc.) node.
-        for org_id, types_list in types.iteritems():
-            if len(types_list) == 1:
-                # Everything's cool here- move along.
-                types[org_id] = types_list[0]
-            else:
-                # Attempt to deconflict the multiple types.  The easiest way
-                # is to check who the organization is a direct child of.
-                org_parents = {
-                    org["_id"]
-                    for org in self.collection.find({"children": org_id}, {"_id": True})
-                }
-                # Get intersection of types_list and org_parents
-                matching_types = set(types_list) & org_parents
-
-                if len(matching_types) == 1:
-                    # Exactly one AGENCY_TYPE is a parent of this org, so
-                    # declare that one to be the official type of this org.
-                    types[org_id] = matching_types.pop()
-                elif len(matching_types) > 1:
-                    # This org is a child of multiple AGENCY_TYPEs; this is
-                    # bad and should be corrected in the database. Assign this
-                    # org a type containing all of the matching types so that
-                    # a human can correct this situation.
-                    types[org_id] = "_".join(matching_types)
-                else:
-                    # No matching types - this should not happen.
-                    types[org_id] = "UNKNOWN"
+        for org_id, org_type in graph.owner_types(include_retired).iteritems():
+            if not stakeholders_only or graph.is_stakeholder(org_id):
+                types[org_id] = org_type
         return types
 
     def get_owner_types(
@@ -1287,7 +1622,7 @@ class RequestDoc(RootDoc):
             result[k] = list(v)
         return result
 
-    def save(self, *args, **kwargs):
+    def __prepare_save(self):
         if self["agency"].get("location"):
             self["agency"]["location"]["gnis_id"] = long(
                 self["agency"]["location"]["gnis_id"]
@@ -1308,7 +1643,70 @@ class RequestDoc(RootDoc):
                 if not self.__EmailAddressRegex.match(email_address):
                     raise ValueError(email_address + " is not a valid email address")
 
+    def __after_save(self, requests):
+        self.invalidate_org_graph()
+        # keep this process's network index in step with the saved networks
+        index = self.__cached(self.__network_indices)
+        if index is not None:
+            for request in requests:
+                index.set_owner(request["_id"], request.get("networks", []))
+
+    def save(self, *args, **kwargs):
+        self.__prepare_save()
         super(RequestDoc, self).save(*args, **kwargs)
+        self.__after_save([self])
+
+    def delete(self):
+        super(RequestDoc, self).delete()
+        self.invalidate_org_graph()
+        index = self.__cached(self.__network_indices)
+        if index is not None:
+            index.remove_owner(self["_id"])
+
+    def save_many(self, requests):
+        """Saves (inserts or replaces) RequestDocs with a single ordered bulk
+        write.  Each request is prepared and validated as by save() before
+        anything is written.  If the write fails, the documents the requests
+        replaced are restored, requests that did not exist are removed, and
+        the error is re-raised.  RequestRollbackError is raised instead if
+        that restore also fails."""
+        if not requests:
+            return
+        ids = [request["_id"] for request in requests]
+        previous = dict(
+            (doc["_id"], doc) for doc in self.collection.find({"_id": {"$in": ids}})
+        )
+        bulk = self.collection.initialize_ordered_bulk_op()
+        for request in requests:
+            request.__prepare_save()
+            request.validate(auto_migrate=False)
+            request._process_custom_type("bson", request, request.structure)
+            bulk.find({"_id": request["_id"]}).upsert().replace_one(dict(request))
+            request._process_custom_type("python", request, request.structure)
+        try:
+            bulk.execute()
+        except PyMongoError:
+            exc_info = sys.exc_info()
+            try:
+                self.__restore(ids, previous)
+            except PyMongoError, e:
+                raise RequestRollbackError(
+                    "Saving requests failed (%s) and restoring the previous "
+                    "requests also failed (%s); some requests may have been "
+                    "written" % (exc_info[1], e)
+                )
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.__after_save(requests)
+
+    def __restore(self, ids, previous):
+        """Puts back the raw documents in previous and removes the other ids"""
+        bulk = self.collection.initialize_ordered_bulk_op()
+        for _id in ids:
+            if _id in previous:
+                bulk.find({"_id": _id}).upsert().replace_one(previous[_id])
+            else:
+                bulk.find({"_id": _id}).remove_one()
+        bulk.execute()
 
 
 class TallyDoc(RootDoc):
@@ -1391,6 +1789,26 @@ class TallyDoc(RootDoc):
         self["counts"][from_stage][from_status] -= delta
         self["counts"][to_stage][to_status] += delta
 
+    def transfer_atomically(
+        self, owner, from_stage, from_status, to_stage, to_status, delta
+    ):
+        """Like transfer, but applied to the tally of owner in the database
+        with a single $inc, so that concurrent commanders cannot overwrite
+        each other's counts.  Returns False if owner has no tally."""
+        if (from_stage, from_status) == (to_stage, to_status) or delta == 0:
+            return self.collection.find_one({"_id": owner}, {"_id": True}) != None
+        result = self.collection.update(
+            spec={"_id": owner},
+            document={
+                "$inc": {
+                    "counts.%s.%s" % (from_stage, from_status): -delta,
+                    "counts.%s.%s" % (to_stage, to_status): delta,
+                },
+                "$set": {"last_change": util.utcnow()},
+            },
+        )
+        return result["n"] == 1
+
     def get_by_owner(self, owner):
         return self.find_one({"_id": owner})
 
@@ -1587,7 +2005,7 @@ class SnapshotDoc(RootDoc):
         return list(self.collection.find({"parents": self["_id"]}, {"_id": True}))
 
 
-class CVEDoc(RootDoc):
+class CVEDoc(ContentHashedDoc):
     __collection__ = CVE_COLLECTION
     structure = {
         "_id": basestring,  # CVE string
@@ -1601,8 +2019,10 @@ class CVEDoc(RootDoc):
     def get_indices(self):
         return tuple()
 
-    def save(self, *args, **kwargs):
-        # Calculate severity from cvss on save
+    @staticmethod
+    def severity_for(cvss_score, cvss_version):
+        """Returns the severity (1-4) of a CVSS score, or None if the CVSS
+        version is not supported"""
         # Source: https://nvd.nist.gov/vuln-metrics/cvss
         #
         # Notes:
@@ -1617,25 +2037,31 @@ class CVEDoc(RootDoc):
         #   has historically assumed severities between 1 and 4 (inclusive).
         #   Since we have not seen CVSSv3 scores lower than 3.1, this will
         #   hopefully never be an issue.
-        cvss = self["cvss_score"]
-        if self["cvss_version"] == "2.0":
-            if cvss == 10:
-                self["severity"] = 4
-            elif cvss >= 7.0:
-                self["severity"] = 3
-            elif cvss >= 4.0:
-                self["severity"] = 2
+        if cvss_version == "2.0":
+            if cvss_score == 10:
+                return 4
+            elif cvss_score >= 7.0:
+                return 3
+            elif cvss_score >= 4.0:
+                return 2
             else:
-                self["severity"] = 1
-        elif self["cvss_version"] in ["3.0", "3.1"]:
-            if cvss >= 9.0:
-                self["severity"] = 4
-            elif cvss >= 7.0:
-                self["severity"] = 3
-            elif cvss >= 4.0:
-                self["severity"] = 2
+                return 1
+        elif cvss_version in ["3.0", "3.1"]:
+            if cvss_score >= 9.0:
+                return 4
+            elif cvss_score >= 7.0:
+                return 3
+            elif cvss_score >= 4.0:
+                return 2
             else:
-                self["severity"] = 1
+                return 1
+        return None
+
+    def save(self, *args, **kwargs):
+        # Calculate severity from cvss on save
+        severity = self.severity_for(self["cvss_score"], self["cvss_version"])
+        if severity is not None:
+            self["severity"] = severity
         super(CVEDoc, self).save(*args, **kwargs)
 
 
@@ -1707,6 +2133,7 @@ class PlaceDoc(RootDoc):
         "longitude_dec": float,
         "elevation_meters": int,
         "elevation_feet": int,
+        "loc": (float, float),  # (longitude_dec, latitude_dec) for geo queries
     }
     required_fields = [
         "_id",
@@ -1720,8 +2147,24 @@ class PlaceDoc(RootDoc):
     ]
     default_values = {}
 
+    @staticmethod
+    def loc_of(doc):
+        """Returns the (longitude, latitude) pair of a place document, or None
+        if it has no coordinates (GNIS uses 0, 0 for unknown coordinates)"""
+        latitude = doc.get("latitude_dec")
+        longitude = doc.get("longitude_dec")
+        if latitude is None or longitude is None or (latitude == longitude == 0):
+            return None
+        return [float(longitude), float(latitude)]
+
     def get_indices(self):
-        return tuple()
+        return (("loc", [("loc", GEOSPHERE)], False, False),)
+
+    def save(self, *args, **kwargs):
+        loc = self.loc_of(self)
+        if loc is not None:
+            self["loc"] = loc
+        super(PlaceDoc, self).save(*args, **kwargs)
 
 
 class NotificationDoc(RootDoc):
@@ -1738,7 +2181,7 @@ class NotificationDoc(RootDoc):
         return tuple()
 
 
-class KEVDoc(RootDoc):
+class KEVDoc(ContentHashedDoc):
     __collection__ = KEV_COLLECTION
     structure = {"_id": basestring, "known_ransomware": bool}
     required_fields = ["_id"]
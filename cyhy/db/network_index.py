@@ -0,0 +1,139 @@
+__all__ = ["NetworkIndex"]
+
+import bisect
+import heapq
+from collections import defaultdict, OrderedDict
+
+import netaddr
+import numpy as np
+
+from cyhy.core.common import UNKNOWN_OWNER
+
+
+class NetworkIndex(object):
+    """Sorted interval index mapping integer address ranges to owners.
+    Intersection queries are answered with a binary search instead of
+    building and intersecting an IPSet per owner."""
+
+    def __init__(self, owner_networks=None):
+        """owner_networks: optional iterable of (owner, networks) pairs, where
+        networks is an iterable of CIDR strings or netaddr.IPNetworks"""
+        self.__networks = dict()  # {owner: [IPNetwork, ...]}
+        self.__intervals = {4: [], 6: []}  # sorted (first, last, owner) triples
+        self.__firsts = {4: [], 6: []}
+        self.__max_lasts = {4: [], 6: []}  # running max of last, for overlaps
+        # IPv4 ranges as NumPy arrays for resolve_owners(); owner 0 is unknown
+        self.__range_firsts = np.array([], dtype=np.int64)
+        self.__range_lasts = np.array([], dtype=np.int64)
+        self.__range_owners = np.array([UNKNOWN_OWNER], dtype=object)
+        self.__dirty = False
+        if owner_networks:
+            for owner, networks in owner_networks:
+                self.set_owner(owner, networks)
+
+    def set_owner(self, owner, networks):
+        """Replaces the networks associated with owner"""
+        networks = [netaddr.IPNetwork(net) for net in networks]
+        if networks:
+            self.__networks[owner] = networks
+        else:
+            self.__networks.pop(owner, None)
+        self.__dirty = True
+
+    def remove_owner(self, owner):
+        self.__networks.pop(owner, None)
+        self.__dirty = True
+
+    def __rebuild(self):
+        intervals = {4: [], 6: []}
+        for owner, networks in self.__networks.iteritems():
+            for net in networks:
+                intervals[net.version].append((net.first, net.last, owner))
+        for version, version_intervals in intervals.items():
+            version_intervals.sort()
+            max_lasts = []
+            max_last = -1
+            for first, last, owner in version_intervals:
+                max_last = max(max_last, last)
+                max_lasts.append(max_last)
+            self.__intervals[version] = version_intervals
+            self.__firsts[version] = [i[0] for i in version_intervals]
+            self.__max_lasts[version] = max_lasts
+
+        # flatten the IPv4 intervals into disjoint ranges, each owned by the
+        # most specific (smallest) network covering it, and coalesce adjacent
+        # ranges with the same owner
+        ranges = []
+        ipv4_intervals = self.__intervals[4]
+        bounds = sorted(
+            set([i[0] for i in ipv4_intervals] + [i[1] + 1 for i in ipv4_intervals])
+        )
+        covering = []  # heap of (size, last, owner)
+        j = 0
+        for start, end in zip(bounds, bounds[1:]):
+            while j < len(ipv4_intervals) and ipv4_intervals[j][0] <= start:
+                first, last, owner = ipv4_intervals[j]
+                heapq.heappush(covering, (last - first, last, owner))
+                j += 1
+            while covering and covering[0][1] < start:
+                heapq.heappop(covering)
+            if not covering:
+                continue
+            owner = covering[0][2]
+            if ranges and ranges[-1][2] == owner and ranges[-1][1] + 1 == start:
+                ranges[-1][1] = end - 1
+            else:
+                ranges.append([start, end - 1, owner])
+        self.__range_firsts = np.array([r[0] for r in ranges], dtype=np.int64)
+        self.__range_lasts = np.array([r[1] for r in ranges], dtype=np.int64)
+        self.__range_owners = np.array(
+            [UNKNOWN_OWNER] + [r[2] for r in ranges], dtype=object
+        )
+        self.__dirty = False
+
+    def overlapping(self, version, first, last):
+        """Generates (first, last, owner) for every indexed interval of the
+        given IP version that overlaps the integer range [first, last]"""
+        if self.__dirty:
+            self.__rebuild()
+        intervals = self.__intervals[version]
+        max_lasts = self.__max_lasts[version]
+        i = bisect.bisect_right(self.__firsts[version], last) - 1
+        while i >= 0 and max_lasts[i] >= first:
+            if intervals[i][1] >= first:
+                yield intervals[i]
+            i -= 1
+
+    def intersections(self, cidrs):
+        """Returns an OrderedDict of {owner: IPSet of intersections} with the
+        netaddr.IPSet cidrs, sorted by owner"""
+        pieces = defaultdict(list)
+        for cidr in cidrs.iter_cidrs():
+            version = cidr.version
+            for first, last, owner in self.overlapping(version, cidr.first, cidr.last):
+                pieces[owner].extend(
+                    netaddr.iprange_to_cidrs(
+                        netaddr.IPAddress(max(first, cidr.first), version),
+                        netaddr.IPAddress(min(last, cidr.last), version),
+                    )
+                )
+        results = OrderedDict()
+        for owner in sorted(pieces):
+            results[owner] = netaddr.IPSet(pieces[owner])
+        return results
+
+    def resolve_owners(self, ip_ints):
+        """Returns a NumPy array of the owners of an iterable or array of
+        integer IPv4 addresses, in the same order.  Unowned addresses resolve
+        to UNKNOWN_OWNER.  Where networks overlap, the most specific
+        (smallest) network containing the address wins."""
+        if self.__dirty:
+            self.__rebuild()
+        ip_ints = np.asarray(
+            ip_ints if hasattr(ip_ints, "__len__") else list(ip_ints), dtype=np.int64
+        )
+        if not len(self.__range_firsts):
+            return self.__range_owners[np.zeros(len(ip_ints), dtype=np.intp)]
+        i = np.searchsorted(self.__range_firsts, ip_ints, side="right") - 1
+        matched = (i >= 0) & (ip_ints <= self.__range_lasts[i])
+        return self.__range_owners[np.where(matched, i + 1, 0)]
@@ -0,0 +1,104 @@
+__all__ = ["OrgGraph"]
+
+from collections import defaultdict
+
+from cyhy.core.common import AGENCY_TYPE
+
+
+class OrgGraph(object):
+    """In-memory organization hierarchy built from request documents.
+    Transitive descendants and agency types are computed once per graph, so
+    hierarchy queries do not touch the database."""
+
+    def __init__(self, orgs):
+        """orgs: iterable of request documents (or projections of them) with
+        _id, and optionally children, stakeholder, and retired"""
+        self.__children = dict()
+        self.__parents = defaultdict(set)
+        self.__stakeholder = dict()
+        self.__retired = dict()
+        for org in orgs:
+            org_id = org["_id"]
+            self.__children[org_id] = list(org.get("children") or [])
+            self.__stakeholder[org_id] = org.get("stakeholder", False)
+            self.__retired[org_id] = org.get("retired", False)
+        for org_id, children in self.__children.iteritems():
+            for child in children:
+                self.__parents[child].add(org_id)
+        # {include_retired: {org: frozenset of descendants}}
+        self.__closures = {True: None, False: None}
+        # {include_retired: {org: agency type}}
+        self.__types = {True: None, False: None}
+
+    def __contains__(self, org_id):
+        return org_id in self.__children
+
+    def is_stakeholder(self, org_id):
+        return self.__stakeholder.get(org_id, False)
+
+    def parents(self, org_id):
+        return set(self.__parents.get(org_id, ()))
+
+    def __closure(self, include_retired):
+        if self.__closures[include_retired] is not None:
+            return self.__closures[include_retired]
+        closure = dict()
+        in_progress = set()  # guards against cycles in bad data
+
+        def visit(org_id):
+            if org_id in closure:
+                return closure[org_id]
+            in_progress.add(org_id)
+            descendants = set()
+            for child in self.__children.get(org_id, []):
+                if child not in self.__children or child in in_progress:
+                    continue
+                if include_retired or not self.__retired[child]:
+                    descendants.add(child)
+                    descendants.update(visit(child))
+            in_progress.discard(org_id)
+            closure[org_id] = frozenset(descendants)
+            return closure[org_id]
+
+        for org_id in self.__children:
+            visit(org_id)
+        self.__closures[include_retired] = closure
+        return closure
+
+    def descendants(self, org_id, stakeholders_only=False, include_retired=False):
+        """Returns the set of descendants of org_id.  Retired orgs (and
+        everything below them) are skipped unless include_retired is set."""
+        if org_id not in self.__children:
+            raise ValueError(org_id + " has no request document")
+        descendants = self.__closure(include_retired)[org_id]
+        if stakeholders_only:
+            return set(d for d in descendants if self.__stakeholder[d])
+        return set(descendants)
+
+    def owner_types(self, include_retired=False):
+        """Returns a dict of {org: agency type} for every org below an
+        AGENCY_TYPE node.  Orgs below several types are resolved to the type
+        they are a direct child of; see RequestDoc.get_owner_to_type_dict."""
+        if self.__types[include_retired] is not None:
+            return self.__types[include_retired]
+        types = defaultdict(list)
+        for agency_type in AGENCY_TYPE:
+            for org_id in self.descendants(
+                agency_type, include_retired=include_retired
+            ):
+                types[org_id].append(agency_type)
+
+        resolved = dict()
+        for org_id, types_list in types.iteritems():
+            if len(types_list) == 1:
+                resolved[org_id] = types_list[0]
+                continue
+            matching_types = set(types_list) & self.__parents.get(org_id, set())
+            if len(matching_types) == 1:
+                resolved[org_id] = matching_types.pop()
+            elif len(matching_types) > 1:
+                resolved[org_id] = "_".join(matching_types)
+            else:
+                resolved[org_id] = "UNKNOWN"
+        self.__types[include_retired] = resolved
+        return resolved
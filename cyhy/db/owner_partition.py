@@ -0,0 +1,60 @@
+__all__ = ["OwnerPartition"]
+
+import bisect
+import hashlib
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class OwnerPartition(object):
+    """Consistent hash ring assigning each owner (RequestDoc _id) to exactly
+    one of a set of commander partitions.  When partitions are added or
+    removed, only the owners of the affected partitions move."""
+
+    def __init__(self, members, member, replicas=100):
+        """members: names of all partitions
+           member: name of the partition owned by this process
+           replicas: number of points each partition has on the ring"""
+        members = sorted(set(members))
+        if member not in members:
+            raise ValueError("%s is not one of the partitions %s" % (member, members))
+        self.__members = members
+        self.__member = member
+        ring = sorted(
+            (_hash(u"%s#%d" % (m, i)), m) for m in members for i in xrange(replicas)
+        )
+        self.__points = [point for point, m in ring]
+        self.__ring_members = [m for point, m in ring]
+
+    @classmethod
+    def numbered(cls, index, count, replicas=100):
+        """Partition index of count partitions named "0" ... "count-1",
+        e.g. OwnerPartition.numbered(2, 4) for the third of four commanders"""
+        if not 0 <= index < count:
+            raise ValueError("partition %d is not in 0..%d" % (index, count - 1))
+        return cls([str(i) for i in xrange(count)], str(index), replicas)
+
+    def __str__(self):
+        return "<OwnerPartition %s of %s>" % (self.__member, self.__members)
+
+    @property
+    def member(self):
+        return self.__member
+
+    @property
+    def members(self):
+        return list(self.__members)
+
+    def member_for(self, owner):
+        """Returns the partition that owner is assigned to"""
+        i = bisect.bisect(self.__points, _hash(owner)) % len(self.__points)
+        return self.__ring_members[i]
+
+    def owns(self, owner):
+        return self.member_for(owner) == self.__member
+
+    def filter(self, owners):
+        """Returns the owners assigned to this partition"""
+        return [owner for owner in owners if self.owns(owner)]
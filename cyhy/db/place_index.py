@@ -0,0 +1,206 @@
+__all__ = ["PlaceIndex"]
+
+import math
+
+import numpy as np
+
+from cyhy.db.database import PlaceDoc
+
+# place fields kept in memory for each indexed place
+PLACE_FIELDS = [
+    "name",
+    "class",
+    "state",
+    "state_name",
+    "state_fips",
+    "county",
+    "county_fips",
+    "country",
+    "country_name",
+    "latitude_dec",
+    "longitude_dec",
+]
+
+# maximum number of distances computed at once (query x candidate pairs)
+MAX_PAIRS_PER_BLOCK = 1 << 22
+
+
+def _unit_vectors(longitudes, latitudes):
+    """Converts degree arrays to an (n, 3) array of unit vectors, so that the
+    nearest place by great circle distance has the largest dot product"""
+    lon = np.radians(longitudes)
+    lat = np.radians(latitudes)
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+class PlaceIndex(object):
+    """In-memory nearest-place index over PlaceDoc coordinates.  Places are
+    bucketed into a latitude/longitude grid held in NumPy arrays, so bulk
+    lookups of host locations need no database queries."""
+
+    def __init__(self, places=None, cell_degrees=1.0):
+        """places: optional iterable of place documents with latitude_dec and
+        longitude_dec fields.  Places without coordinates are ignored."""
+        self.__cell_degrees = float(cell_degrees)
+        self.__rows = int(math.ceil(180.0 / self.__cell_degrees))
+        self.__cols = int(math.ceil(360.0 / self.__cell_degrees))
+        self.__places = []
+        self.__vectors = np.zeros((0, 3))
+        self.__cell_starts = np.zeros(self.__rows * self.__cols + 1, dtype=np.int64)
+        if places:
+            self.__build(places)
+
+    @classmethod
+    def from_db(cls, db, spec=None, cell_degrees=1.0):
+        """Loads the places matching spec (all places if None) with a single
+        projected query"""
+        cursor = db.PlaceDoc.collection.find(spec or {}, fields=PLACE_FIELDS)
+        return cls(cursor, cell_degrees)
+
+    def __len__(self):
+        return len(self.__places)
+
+    def __cells(self, longitudes, latitudes):
+        """Returns the (row, col) grid cells containing the given degrees"""
+        rows = np.floor((latitudes + 90.0) / self.__cell_degrees).astype(np.int64)
+        cols = np.floor((longitudes + 180.0) / self.__cell_degrees).astype(np.int64)
+        return (
+            np.clip(rows, 0, self.__rows - 1),
+            np.clip(cols, 0, self.__cols - 1),
+        )
+
+    def __build(self, places):
+        places = [p for p in places if PlaceDoc.loc_of(p) is not None]
+        if not places:
+            return
+        longitudes = np.array([p["longitude_dec"] for p in places], dtype=float)
+        latitudes = np.array([p["latitude_dec"] for p in places], dtype=float)
+        rows, cols = self.__cells(longitudes, latitudes)
+        cells = rows * self.__cols + cols
+        order = np.argsort(cells, kind="mergesort")
+        self.__places = [places[i] for i in order]
+        self.__vectors = _unit_vectors(longitudes[order], latitudes[order])
+        # places in cell c are self.__places[cell_starts[c]:cell_starts[c + 1]]
+        self.__cell_starts = np.searchsorted(
+            cells[order], np.arange(self.__rows * self.__cols + 1)
+        )
+
+    def __candidates(self, row_range, col_range):
+        """Returns the indices of the places in the grid rows and columns of
+        the inclusive ranges.  Column ranges wrap around the antimeridian."""
+        first_col, last_col = col_range
+        if last_col - first_col + 1 >= self.__cols:
+            col_spans = [(0, self.__cols - 1)]
+        else:
+            first_col %= self.__cols
+            last_col %= self.__cols
+            if first_col <= last_col:
+                col_spans = [(first_col, last_col)]
+            else:
+                col_spans = [(first_col, self.__cols - 1), (0, last_col)]
+        slices = []
+        for row in xrange(max(row_range[0], 0), min(row_range[1], self.__rows - 1) + 1):
+            for first, last in col_spans:
+                start = self.__cell_starts[row * self.__cols + first]
+                end = self.__cell_starts[row * self.__cols + last + 1]
+                if end > start:
+                    slices.append(np.arange(start, end))
+        if not slices:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(slices)
+
+    def __nearest(self, vectors, candidates):
+        """Returns the nearest candidate index and its angular distance (in
+        radians) for each of the query unit vectors"""
+        nearest = np.empty(len(vectors), dtype=np.int64)
+        dots = np.empty(len(vectors))
+        candidate_vectors = self.__vectors[candidates].T
+        block = max(1, MAX_PAIRS_PER_BLOCK // len(candidates))
+        for start in xrange(0, len(vectors), block):
+            products = np.dot(vectors[start : start + block], candidate_vectors)
+            best = products.argmax(axis=1)
+            nearest[start : start + block] = candidates[best]
+            dots[start : start + block] = products[np.arange(len(best)), best]
+        return nearest, np.arccos(np.clip(dots, -1.0, 1.0))
+
+    def __nearest_in_cell(self, row, col, vectors):
+        """Finds the nearest places for query vectors that all lie in the grid
+        cell (row, col).  The rings of cells around it are searched until a
+        place is found, then the search is widened to every cell that could
+        hold a nearer place."""
+        cell = math.radians(self.__cell_degrees)
+        ring = 1
+        while True:
+            candidates = self.__candidates(
+                (row - ring, row + ring), (col - ring, col + ring)
+            )
+            if len(candidates):
+                break
+            ring += 1
+        nearest, distances = self.__nearest(vectors, candidates)
+
+        # Any nearer place lies within the largest distance found, which
+        # bounds its latitude directly, and its longitude by the haversine
+        # formula at the widest latitude of that band.
+        max_distance = distances.max()
+        lat_min = row * cell - math.pi / 2 - max_distance
+        lat_max = (row + 1) * cell - math.pi / 2 + max_distance
+        widest = max(abs(lat_min), abs(lat_max))
+        if widest >= math.pi / 2:
+            lon_margin = math.pi
+        else:
+            lon_margin = 2 * math.asin(
+                min(1.0, math.sin(max_distance / 2) / math.cos(widest))
+            )
+        row_margin = int(math.ceil(max_distance / cell))
+        col_margin = int(math.ceil(lon_margin / cell))
+        if row_margin > ring or col_margin > ring:
+            candidates = self.__candidates(
+                (row - row_margin, row + row_margin),
+                (col - col_margin, col + col_margin),
+            )
+            nearest, distances = self.__nearest(vectors, candidates)
+        return nearest
+
+    def nearest_places(self, locs):
+        """Returns the nearest indexed place document for each (longitude,
+        latitude) pair in locs, the same order as HostDoc loc.  None is
+        returned for locations without coordinates, or if no places are
+        indexed."""
+        locs = list(locs)
+        results = [None] * len(locs)
+        if not self.__places:
+            return results
+        known = [
+            i
+            for i, loc in enumerate(locs)
+            if loc is not None and None not in (loc[0], loc[1])
+        ]
+        if not known:
+            return results
+
+        # hosts share few distinct locations, so only look up each one once
+        points = np.array([locs[i][:2] for i in known], dtype=float)
+        points, inverse = np.unique(
+            points.view([("", float), ("", float)]), return_inverse=True
+        )
+        points = points.view(float).reshape(-1, 2)
+        rows, cols = self.__cells(points[:, 0], points[:, 1])
+        vectors = _unit_vectors(points[:, 0], points[:, 1])
+        nearest = np.empty(len(points), dtype=np.int64)
+
+        cells = rows * self.__cols + cols
+        order = np.argsort(cells, kind="mergesort")
+        boundaries = np.flatnonzero(np.diff(cells[order])) + 1
+        for group in np.split(order, boundaries):
+            nearest[group] = self.__nearest_in_cell(
+                rows[group[0]], cols[group[0]], vectors[group]
+            )
+
+        for i, point_index in zip(known, inverse):
+            results[i] = self.__places[nearest[point_index]]
+        return results
+
+    def nearest_place(self, loc):
+        return self.nearest_places([loc])[0]
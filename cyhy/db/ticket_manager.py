@@ -1,4 +1,9 @@
-__all__ = ["VulnTicketManager", "IPPortTicketManager", "IPTicketManager"]
+__all__ = [
+    "VulnTicketManager",
+    "IPPortTicketManager",
+    "IPTicketManager",
+    "CVETicketRescorer",
+]
 
 from collections import defaultdict
 from dateutil import relativedelta, tz
@@ -58,7 +63,8 @@ class VulnTicketManager(object):
     def __mark_seen(self, vuln):
         self.__seen_ticket_ids.add(vuln["_id"])
 
-    def __calculate_delta(self, d1, d2):
+    @staticmethod
+    def calculate_delta(d1, d2):
         """d1 and d2 are dictionaries.  Returns a list of changes."""
         delta = []
         all_keys = set(d1.keys() + d2.keys())
@@ -87,13 +93,11 @@ class VulnTicketManager(object):
                     event["manual"] = True
                 ticket["events"].append(event)
 
-    def __generate_ticket_details(self, vuln, ticket, check_for_changes=True):
-        """Generate the contents of the ticket's details field using NVD data.
-
-        If check_for_changes is True, it will detect changes in the details,
-        and generate a CHANGED event.  If a delta is generated, it will be
-        returned.  If no delta is generated, an empty list is returned."""
-
+    @staticmethod
+    def calculate_details(vuln, cve_doc=None, kev_doc=None):
+        """Returns the contents of a ticket's details field for vuln, using
+        the NVD data in cve_doc and the KEV data in kev_doc (either may be
+        None)."""
         new_details = {
             "cve": vuln.get("cve"),
             "cvss_base_score": vuln.get("cvss3_base_score", vuln["cvss_base_score"]),
@@ -106,20 +110,16 @@ class VulnTicketManager(object):
             "vpr_score": vuln.get("vpr_score"),
         }
 
-        if "cve" in vuln:
-            # if we have a CVE, we can try to get the details from the NVD
-            cve_doc = self.__db.CVEDoc.find_one({"_id": vuln["cve"]})
-            if cve_doc:
-                new_details["cvss_base_score"] = cve_doc["cvss_score"]
-                new_details["cvss_version"] = cve_doc["cvss_version"]
-                new_details["score_source"] = "nvd"
-                new_details["severity"] = cve_doc["severity"]
-            # if the CVE is listed in the KEV collection, we'll mark it as such
-            kev_doc = self.__db.KEVDoc.find_one({"_id": vuln["cve"]})
-            if kev_doc:
-                new_details["kev"] = True
-                if kev_doc.get("known_ransomware"):
-                    new_details["kev_ransomware"] = True
+        if cve_doc:
+            new_details["cvss_base_score"] = cve_doc["cvss_score"]
+            new_details["cvss_version"] = cve_doc["cvss_version"]
+            new_details["score_source"] = "nvd"
+            new_details["severity"] = cve_doc["severity"]
+        # if the CVE is listed in the KEV collection, we'll mark it as such
+        if kev_doc:
+            new_details["kev"] = True
+            if kev_doc.get("known_ransomware"):
+                new_details["kev_ransomware"] = True
 
         # As of May 2022, some Nessus plugins report a severity that is
         # inconsistent with their (non-NVD, non-CVE-based) CVSS v3 score.
@@ -161,9 +161,38 @@ class VulnTicketManager(object):
                 else:
                     new_details["severity"] = 1
 
+        return new_details
+
+    @staticmethod
+    def delta_needs_notification(delta):
+        """Returns True if a details delta calls for a notification:
+        - Severity delta goes from less than 3 (High) to 3 or greater
+        - KEV delta goes from False to True"""
+        for d in delta:
+            if d["key"] == "severity":
+                if d["from"] < 3 and d["to"] >= 3:
+                    return True
+            if d["key"] == "kev":
+                if d["from"] is False and d["to"] is True:
+                    return True
+        return False
+
+    def __generate_ticket_details(self, vuln, ticket, check_for_changes=True):
+        """Generate the contents of the ticket's details field using NVD data.
+
+        If check_for_changes is True, it will detect changes in the details,
+        and generate a CHANGED event.  If a delta is generated, it will be
+        returned.  If no delta is generated, an empty list is returned."""
+        cve_doc = kev_doc = None
+        if "cve" in vuln:
+            # if we have a CVE, we can try to get the details from the NVD
+            cve_doc = self.__db.CVEDoc.find_one({"_id": vuln["cve"]})
+            kev_doc = self.__db.KEVDoc.find_one({"_id": vuln["cve"]})
+        new_details = self.calculate_details(vuln, cve_doc, kev_doc)
+
         delta = []
         if check_for_changes:
-            delta = self.__calculate_delta(ticket["details"], new_details)
+            delta = self.calculate_delta(ticket["details"], new_details)
             if delta:
                 event = {
                     "action": TICKET_EVENT.CHANGED,
@@ -228,16 +257,10 @@ class VulnTicketManager(object):
             # Create a notification for non-false positive tickets if:
             # - Severity delta goes from less than 3 (High) to 3 or greater
             # - KEV delta goes from False to True
-            if not prev_open_ticket.get("false_positive"):
-                for d in delta:
-                    if d["key"] == "severity":
-                        if d["from"] < 3 and d["to"] >= 3:
-                            self.__create_notification(prev_open_ticket)
-                            break
-                    if d["key"] == "kev":
-                        if d["from"] is False and d["to"] is True:
-                            self.__create_notification(prev_open_ticket)
-                            break
+            if not prev_open_ticket.get(
+                "false_positive"
+            ) and self.delta_needs_notification(delta):
+                self.__create_notification(prev_open_ticket)
             return
 
         # no matching tickets are currently open
@@ -274,15 +297,8 @@ class VulnTicketManager(object):
             # Create a notification if:
             # - Severity delta goes from less than 3 (High) to 3 or greater
             # - KEV delta goes from False to True
-            for d in delta:
-                if d["key"] == "severity":
-                    if d["from"] < 3 and d["to"] >= 3:
-                        self.__create_notification(reopen_ticket)
-                        break
-                if d["key"] == "kev":
-                    if d["from"] is False and d["to"] is True:
-                        self.__create_notification(reopen_ticket)
-                        break
+            if self.delta_needs_notification(delta):
+                self.__create_notification(reopen_ticket)
             return
 
         # time to open a new ticket
@@ -743,3 +759,126 @@ class IPTicketManager(object):
         for doc in vuln_docs:
             doc["latest"] = False
             doc.save()
+
+
+class CVETicketRescorer(object):
+    """Recalculates the details of open vulnerability tickets for CVEs whose
+    NVD or KEV data has changed, without waiting for a rescan"""
+
+    # ticket events that reference the vuln scan that produced them
+    DETECTION_EVENTS = (
+        TICKET_EVENT.OPENED,
+        TICKET_EVENT.VERIFIED,
+        TICKET_EVENT.REOPENED,
+    )
+
+    def __init__(self, db, chunk_size=1000):
+        self.__db = db
+        self.__chunk_size = chunk_size
+
+    def __latest_vuln_id(self, ticket):
+        for event in reversed(ticket["events"]):
+            if event["action"] in self.DETECTION_EVENTS and event.get("reference"):
+                return event["reference"]
+        return None
+
+    def __overlay_details(self, details, cve_doc, kev_doc):
+        """Refreshes only the NVD and KEV fields of details; used when the
+        vuln scan behind a ticket has been archived."""
+        new_details = dict(details)
+        if cve_doc:
+            new_details["cvss_base_score"] = cve_doc["cvss_score"]
+            new_details["cvss_version"] = cve_doc["cvss_version"]
+            new_details["score_source"] = "nvd"
+            new_details["severity"] = cve_doc["severity"]
+        new_details["kev"] = kev_doc is not None
+        new_details["kev_ransomware"] = bool(
+            kev_doc and kev_doc.get("known_ransomware")
+        )
+        return new_details
+
+    def __by_id(self, collection, ids, fields=None):
+        return dict(
+            (doc["_id"], doc) for doc in collection.find({"_id": {"$in": ids}}, fields)
+        )
+
+    def __rescore_chunk(self, cve_ids, time):
+        tickets = list(
+            self.__db.TicketDoc.collection.find(
+                {"details.cve": {"$in": cve_ids}, "open": True},
+                {"details": True, "events": True, "owner": True, "false_positive": True},
+            )
+        )
+        if not tickets:
+            return 0, 0
+        cve_docs = self.__by_id(self.__db.CVEDoc.collection, cve_ids)
+        kev_docs = self.__by_id(self.__db.KEVDoc.collection, cve_ids)
+        vuln_ids = dict((t["_id"], self.__latest_vuln_id(t)) for t in tickets)
+        vulns = self.__by_id(
+            self.__db.VulnScanDoc.collection,
+            [i for i in vuln_ids.itervalues() if i is not None],
+        )
+
+        bulk = self.__db.TicketDoc.collection.initialize_unordered_bulk_op()
+        changed_count = 0
+        notifications = []
+        for ticket in tickets:
+            cve = ticket["details"]["cve"]
+            vuln = vulns.get(vuln_ids[ticket["_id"]])
+            if vuln:
+                new_details = VulnTicketManager.calculate_details(
+                    vuln, cve_docs.get(cve), kev_docs.get(cve)
+                )
+            else:
+                new_details = self.__overlay_details(
+                    ticket["details"], cve_docs.get(cve), kev_docs.get(cve)
+                )
+            delta = VulnTicketManager.calculate_delta(ticket["details"], new_details)
+            if not delta:
+                continue
+            event = {
+                "action": TICKET_EVENT.CHANGED,
+                "delta": delta,
+                "reason": "details changed",
+                "reference": None,
+                "time": time,
+            }
+            bulk.find({"_id": ticket["_id"], "open": True}).update_one(
+                {
+                    "$set": {"details": new_details, "last_change": time},
+                    "$push": {"events": event},
+                }
+            )
+            changed_count += 1
+            if not ticket.get(
+                "false_positive"
+            ) and VulnTicketManager.delta_needs_notification(delta):
+                notifications.append(
+                    {
+                        "ticket_id": ticket["_id"],
+                        "ticket_owner": ticket["owner"],
+                        "generated_for": list(),
+                    }
+                )
+        if changed_count:
+            bulk.execute()
+        if notifications:
+            self.__db.NotificationDoc.collection.insert(notifications)
+        return changed_count, len(notifications)
+
+    def rescore(self, cve_ids, time=None):
+        """Recalculates the details of open tickets for cve_ids, adding a
+        CHANGED event to each ticket whose details change, and creating
+        notifications by the same rules as VulnTicketManager.
+        Returns (changed ticket count, notification count)."""
+        if time is None:
+            time = util.utcnow()
+        cve_ids = sorted(set(cve_ids))
+        changed_count = notification_count = 0
+        for i in xrange(0, len(cve_ids), self.__chunk_size):
+            changed, notified = self.__rescore_chunk(
+                cve_ids[i : i + self.__chunk_size], time
+            )
+            changed_count += changed
+            notification_count += notified
+        return changed_count, notification_count
@@ -0,0 +1,107 @@
+#!/usr/bin/env py.test -v
+
+import datetime
+
+import netaddr
+import pytest
+
+from cyhy.core.common import *
+from cyhy.db import CHDatabase, OwnerPartition
+from cyhy.util import util
+from common_fixtures import database
+
+OWNER = "CLAIM_TEST"
+HOST_COUNT = 10
+
+
+@pytest.fixture
+def hosts(database):
+    database.HostDoc.collection.remove({"owner": OWNER})
+    database.TallyDoc.collection.remove({"_id": OWNER})
+    tally = database.TallyDoc()
+    tally["_id"] = OWNER
+    for i in range(HOST_COUNT):
+        host = database.HostDoc()
+        host["ip"] = netaddr.IPAddress("192.0.2.%d" % (i + 1))
+        host["_id"] = int(host["ip"])
+        host["owner"] = OWNER
+        host["stage"] = STAGE.NETSCAN1
+        host["status"] = STATUS.READY
+        host.save()
+    tally["counts"][STAGE.NETSCAN1][STATUS.READY] = HOST_COUNT
+    tally.save()
+    yield database
+    database.HostDoc.collection.remove({"owner": OWNER})
+    database.TallyDoc.collection.remove({"_id": OWNER})
+
+
+def counts(database):
+    return database.TallyDoc.get_by_owner(OWNER)["counts"][STAGE.NETSCAN1]
+
+
+class TestHostClaims:
+    def test_default_commander_ids_are_unique(self, database):
+        first = CHDatabase(database).commander_id
+        second = CHDatabase(database).commander_id
+        assert first != second
+        assert first.rsplit(":", 1)[0] == second.rsplit(":", 1)[0]
+
+    def test_commanders_claim_distinct_hosts(self, hosts):
+        first = CHDatabase(hosts, commander_id="first")
+        second = CHDatabase(hosts, commander_id="second")
+        first_ips = first.fetch_ready_hosts(6, STAGE.NETSCAN1, OWNER)
+        second_ips = second.fetch_ready_hosts(6, STAGE.NETSCAN1, OWNER)
+        assert len(first_ips) == 6
+        assert len(second_ips) == HOST_COUNT - 6
+        assert not set(first_ips) & set(second_ips)
+        for ip in first_ips:
+            host = hosts.HostDoc.get_by_ip(ip)
+            assert host["status"] == STATUS.RUNNING
+            assert host["claimed_by"] == "first"
+        assert counts(hosts)[STATUS.READY] == 0
+        assert counts(hosts)[STATUS.RUNNING] == HOST_COUNT
+
+    def test_transition_releases_claim(self, hosts):
+        ch_db = CHDatabase(hosts, commander_id="first")
+        (ip,) = ch_db.fetch_ready_hosts(1, STAGE.NETSCAN1, OWNER)
+        host, changed = ch_db.transition_host(ip, up=False)
+        assert changed
+        host = hosts.HostDoc.get_by_ip(ip)
+        assert host["status"] == STATUS.WAITING
+        assert "claimed_by" not in host
+        assert "claim_time" not in host
+
+    def test_stale_claims_are_reclaimed(self, hosts):
+        crashed = CHDatabase(hosts, commander_id="crashed")
+        alive = CHDatabase(hosts, commander_id="alive")
+        crashed.fetch_ready_hosts(3, STAGE.NETSCAN1, OWNER)
+        alive_ips = alive.fetch_ready_hosts(2, STAGE.NETSCAN1, OWNER)
+        hosts.HostDoc.collection.update(
+            {"claimed_by": {"$in": ["crashed", "alive"]}},
+            {"$set": {"claim_time": util.utcnow() - datetime.timedelta(hours=1)}},
+            multi=True,
+        )
+        assert alive.renew_claims() == 2
+        assert alive.reclaim_stale_hosts() == 3
+        for ip in alive_ips:
+            assert hosts.HostDoc.get_by_ip(ip)["status"] == STATUS.RUNNING
+        assert counts(hosts)[STATUS.RUNNING] == 2
+        assert counts(hosts)[STATUS.WAITING] == 3
+        assert hosts.HostDoc.collection.find({"claimed_by": "crashed"}).count() == 0
+
+
+class TestPartitionedClaims:
+    def test_only_partition_owners_are_fetched(self, hosts, request):
+        hosts.RequestDoc.collection.save({"_id": OWNER, "scan_types": [SCAN_TYPE.CYHY]})
+        request.addfinalizer(lambda: hosts.RequestDoc.collection.remove(OWNER))
+        members = ["first", "second"]
+        partition = OwnerPartition(members, "first")
+        if partition.owns(OWNER):
+            partition = OwnerPartition(members, "second")
+        ch_db = CHDatabase(hosts, commander_id="other", partition=partition)
+        assert OWNER not in ch_db.request_limits()
+        assert ch_db.fetch_ready_hosts(HOST_COUNT, STAGE.NETSCAN1) == []
+        ch_db.set_partition(OwnerPartition(members, partition.member_for(OWNER)))
+        assert len(ch_db.fetch_ready_hosts(HOST_COUNT, STAGE.NETSCAN1)) == (
+            HOST_COUNT
+        )
@@ -7,12 +7,15 @@ import pytest
 
 import struct
 import hashlib
+import time
 import Crypto.Random.random as random
 from base64 import b64encode, b64decode
 
 from bson.binary import Binary
+from Crypto.Cipher import AES
 import netaddr
 import netaddr.strategy
+import numpy as np
 
 from cyhy.db import CryptoKey, IPCoder
 from common_fixtures import *
@@ -71,6 +74,68 @@ class TestCryptoKey:
         assert k.key != key.key
 
 
+class TestCryptoKeyPBKDF2:
+    def test_key_creation_and_check(self):
+        key = CryptoKey(
+            CORRECT_PASSWORD,
+            computation_time=COMP_TIME,
+            kdf=CryptoKey.KDF_PBKDF2_SHA256,
+        )
+        assert key.kdf == CryptoKey.KDF_PBKDF2_SHA256
+        assert key.rounds > 0
+        k = CryptoKey(
+            CORRECT_PASSWORD,
+            key.salt,
+            key.rounds,
+            key.key_check,
+            kdf=CryptoKey.KDF_PBKDF2_SHA256,
+        )
+        assert k.key == key.key
+        assert len(k.key) == CryptoKey.KEY_SIZE
+
+    def test_bad_key_check(self):
+        key = CryptoKey(
+            CORRECT_PASSWORD,
+            computation_time=COMP_TIME,
+            kdf=CryptoKey.KDF_PBKDF2_SHA256,
+        )
+        with pytest.raises(Exception):
+            CryptoKey(
+                INCORRECT_PASSWORD,
+                key.salt,
+                key.rounds,
+                key.key_check,
+                kdf=CryptoKey.KDF_PBKDF2_SHA256,
+            )
+
+    def test_kdf_is_part_of_key(self, key):
+        with pytest.raises(Exception):
+            CryptoKey(
+                CORRECT_PASSWORD,
+                key.salt,
+                key.rounds,
+                key.key_check,
+                kdf=CryptoKey.KDF_PBKDF2_SHA256,
+            )
+
+    def test_unknown_kdf(self):
+        with pytest.raises(ValueError):
+            CryptoKey(CORRECT_PASSWORD, kdf="rot13")
+
+
+class TestCryptoKeyCache:
+    def test_cached_key_matches_derived_key(self, key):
+        start = time.time()
+        k = CryptoKey(CORRECT_PASSWORD, key.salt, key.rounds, key.key_check)
+        assert time.time() - start < COMP_TIME / 2
+        assert k.key == key.key
+
+    def test_cache_does_not_accept_other_passwords(self, key):
+        CryptoKey(CORRECT_PASSWORD, key.salt, key.rounds, key.key_check)
+        with pytest.raises(Exception):
+            CryptoKey(INCORRECT_PASSWORD, key.salt, key.rounds, key.key_check)
+
+
 @pytest.mark.parametrize(("address"), ADDRESSES, scope="class")
 class TestIPCoderToMemory:
     def test_encrypt_to_memory(self, key, address):
@@ -101,6 +166,66 @@ class TestIPCoderToMemory:
         assert ip == netaddr.IPAddress(address)
 
 
+class TestIPCoderBatch:
+    def test_encrypt_many_matches_cbc(self, key):
+        iv = "".join(chr(random.randint(0, 0xFF)) for i in range(16))
+        coder = IPCoder(key.key, iv)
+        for version in (4, 6):
+            ips = [netaddr.IPAddress(a) for a in ADDRESSES + ("10.0.0.32",)]
+            ips = [ip for ip in ips if ip.version == version]
+            for ip, ciphertext in zip(ips, coder.encrypt_many(ips, version)):
+                encryptor = AES.new(key.key, AES.MODE_CBC, iv)
+                assert ciphertext == encryptor.encrypt(coder.pad(ip.packed))
+
+    def test_encrypt_many_integer_array(self, key):
+        iv = "".join(chr(random.randint(0, 0xFF)) for i in range(16))
+        coder = IPCoder(key.key, iv)
+        ip_ints = np.arange(0xC0A80000, 0xC0A80100, dtype=np.uint32)
+        ciphertexts = coder.encrypt_many(ip_ints)
+        assert ciphertexts[7] == coder.encrypt(netaddr.IPAddress(int(ip_ints[7])))
+        assert coder.decrypt_many(ciphertexts) == [
+            netaddr.IPAddress(int(i)) for i in ip_ints
+        ]
+
+    def test_encrypt_many_infers_version(self, key):
+        iv = "".join(chr(random.randint(0, 0xFF)) for i in range(16))
+        coder = IPCoder(key.key, iv)
+        ips = [netaddr.IPAddress("::1"), netaddr.IPAddress("2001:db8::1")]
+        ciphertexts = coder.encrypt_many(ips)
+        assert ciphertexts == [coder.encrypt(ip) for ip in ips]
+        assert coder.decrypt_many(ciphertexts) == ips
+
+    def test_encrypt_many_rejects_out_of_range(self, key):
+        iv = "".join(chr(random.randint(0, 0xFF)) for i in range(16))
+        coder = IPCoder(key.key, iv)
+        with pytest.raises(ValueError):
+            coder.encrypt_many([2 ** 32])
+        with pytest.raises(ValueError):
+            coder.encrypt_many(np.array([1, 2 ** 40], dtype=np.uint64))
+        with pytest.raises(ValueError):
+            coder.encrypt_many([-1], 6)
+        with pytest.raises(ValueError):
+            coder.encrypt_many([2 ** 128], 6)
+
+    def test_encrypt_many_rejects_wrong_version(self, key):
+        iv = "".join(chr(random.randint(0, 0xFF)) for i in range(16))
+        coder = IPCoder(key.key, iv)
+        with pytest.raises(ValueError):
+            coder.encrypt_many([netaddr.IPAddress("2001:db8::1")], 4)
+        with pytest.raises(ValueError):
+            coder.encrypt_many(
+                [netaddr.IPAddress("10.0.0.1"), netaddr.IPAddress("::1")]
+            )
+
+    def test_decrypt_many_mixed_versions(self, key):
+        iv = "".join(chr(random.randint(0, 0xFF)) for i in range(16))
+        coder = IPCoder(key.key, iv)
+        ips = [netaddr.IPAddress(a) for a in ADDRESSES]
+        ciphertexts = [coder.encrypt(ip) for ip in ips]
+        assert coder.decrypt_many(ciphertexts) == ips
+        assert coder.decrypt_many([]) == []
+
+
 # @pytest.mark.xfail(run=False, reason='requires local mongodb')
 @pytest.mark.parametrize(("address"), ADDRESSES, scope="class")
 class TestIPCoderToDatabase:
@@ -0,0 +1,83 @@
+#!/usr/bin/env py.test -v
+
+import pytest
+from netaddr import IPAddress, IPSet
+
+from cyhy.core.common import UNKNOWN_OWNER
+from cyhy.db import NetworkIndex
+
+
+@pytest.fixture
+def index():
+    return NetworkIndex(
+        [
+            ("ALPHA", ["10.0.0.0/24", "10.0.2.0/24"]),
+            ("BRAVO", ["10.0.1.0/24"]),
+            ("CHARLIE", ["10.0.0.0/8"]),  # overlaps everything above
+            ("DELTA", ["2001:db8::/64"]),
+            ("ECHO", []),
+        ]
+    )
+
+
+class TestNetworkIndex:
+    def test_no_intersections(self, index):
+        assert index.intersections(IPSet(["192.168.0.0/16"])) == {}
+
+    def test_intersections(self, index):
+        results = index.intersections(IPSet(["10.0.0.128/25", "10.0.1.0/30"]))
+        assert results.keys() == ["ALPHA", "BRAVO", "CHARLIE"]
+        assert results["ALPHA"] == IPSet(["10.0.0.128/25"])
+        assert results["BRAVO"] == IPSet(["10.0.1.0/30"])
+        assert results["CHARLIE"] == IPSet(["10.0.0.128/25", "10.0.1.0/30"])
+
+    def test_ip_versions_are_separate(self, index):
+        # ::/96 integers collide with IPv4 integers
+        results = index.intersections(IPSet(["::a00:0/120", "2001:db8::1"]))
+        assert results.keys() == ["DELTA"]
+
+    def test_set_owner(self, index):
+        index.set_owner("BRAVO", ["192.168.0.0/24"])
+        results = index.intersections(IPSet(["10.0.1.0/24", "192.168.0.1"]))
+        assert results.keys() == ["BRAVO", "CHARLIE"]
+        assert results["BRAVO"] == IPSet(["192.168.0.1"])
+
+    def test_remove_owner(self, index):
+        index.remove_owner("CHARLIE")
+        results = index.intersections(IPSet(["10.0.0.0/8"]))
+        assert results.keys() == ["ALPHA", "BRAVO"]
+
+    def test_resolve_owners(self, index):
+        index.remove_owner("CHARLIE")
+        ip_ints = [
+            int(IPAddress("10.0.0.0")),
+            int(IPAddress("10.0.1.255")),
+            int(IPAddress("10.0.2.7")),
+            int(IPAddress("10.0.3.0")),
+            int(IPAddress("9.255.255.255")),
+        ]
+        owners = index.resolve_owners(ip_ints)
+        assert list(owners) == ["ALPHA", "BRAVO", "ALPHA", UNKNOWN_OWNER, UNKNOWN_OWNER]
+
+    def test_resolve_owners_overlapping(self, index):
+        ip_ints = [
+            int(IPAddress("10.0.0.1")),  # ALPHA /24 inside CHARLIE /8
+            int(IPAddress("10.0.1.1")),  # BRAVO /24 inside CHARLIE /8
+            int(IPAddress("10.0.2.255")),
+            int(IPAddress("10.0.5.1")),  # only in CHARLIE
+            int(IPAddress("10.255.255.255")),
+            int(IPAddress("11.0.0.0")),
+        ]
+        owners = index.resolve_owners(ip_ints)
+        assert list(owners) == [
+            "ALPHA",
+            "BRAVO",
+            "ALPHA",
+            "CHARLIE",
+            "CHARLIE",
+            UNKNOWN_OWNER,
+        ]
+
+    def test_resolve_owners_empty_index(self):
+        owners = NetworkIndex().resolve_owners(xrange(3))
+        assert list(owners) == [UNKNOWN_OWNER] * 3
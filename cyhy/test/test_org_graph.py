@@ -0,0 +1,61 @@
+#!/usr/bin/env py.test -v
+
+import pytest
+
+from cyhy.db import OrgGraph
+
+ORGS = (
+    {"_id": "FEDERAL", "children": ["AGENCY", "SHARED"]},
+    {"_id": "STATE", "children": ["STATE1"]},
+    {"_id": "LOCAL"},
+    {"_id": "PRIVATE"},
+    {"_id": "TRIBAL"},
+    {"_id": "TERRITORIAL"},
+    {"_id": "AGENCY", "children": ["BUREAU", "OLD"], "stakeholder": True},
+    {"_id": "BUREAU", "children": [], "stakeholder": True},
+    {"_id": "OLD", "children": ["OLD_CHILD"], "retired": True},
+    {"_id": "OLD_CHILD", "stakeholder": True},
+    {"_id": "STATE1", "children": ["SHARED"], "stakeholder": True},
+    {"_id": "SHARED", "stakeholder": False},
+)
+
+
+@pytest.fixture
+def graph():
+    return OrgGraph(ORGS)
+
+
+class TestOrgGraph:
+    def test_descendants(self, graph):
+        assert graph.descendants("AGENCY") == {"BUREAU"}
+        assert graph.descendants("FEDERAL") == {"AGENCY", "BUREAU", "SHARED"}
+        assert graph.descendants("BUREAU") == set()
+
+    def test_descendants_include_retired(self, graph):
+        assert graph.descendants("AGENCY", include_retired=True) == {
+            "BUREAU",
+            "OLD",
+            "OLD_CHILD",
+        }
+
+    def test_descendants_stakeholders_only(self, graph):
+        assert graph.descendants("FEDERAL", stakeholders_only=True) == {
+            "AGENCY",
+            "BUREAU",
+        }
+
+    def test_unknown_org(self, graph):
+        with pytest.raises(ValueError):
+            graph.descendants("NOBODY")
+
+    def test_owner_types(self, graph):
+        types = graph.owner_types()
+        assert types["BUREAU"] == "FEDERAL"
+        assert types["STATE1"] == "STATE"
+        # direct child of FEDERAL, and a grandchild of STATE
+        assert types["SHARED"] == "FEDERAL"
+        assert "OLD_CHILD" not in types
+        assert graph.owner_types(include_retired=True)["OLD_CHILD"] == "FEDERAL"
+
+    def test_parents(self, graph):
+        assert graph.parents("SHARED") == {"FEDERAL", "STATE1"}
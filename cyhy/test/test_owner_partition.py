@@ -0,0 +1,50 @@
+#!/usr/bin/env py.test -v
+
+import pytest
+
+from cyhy.db import OwnerPartition
+
+OWNERS = ["OWNER%03d" % i for i in range(1000)]
+
+
+def assignments(count):
+    partition = OwnerPartition.numbered(0, count)
+    return dict((owner, partition.member_for(owner)) for owner in OWNERS)
+
+
+class TestOwnerPartition:
+    def test_each_owner_in_one_partition(self):
+        partitions = [OwnerPartition.numbered(i, 4) for i in range(4)]
+        for owner in OWNERS:
+            assert sum(p.owns(owner) for p in partitions) == 1
+        assert sorted(sum((p.filter(OWNERS) for p in partitions), [])) == OWNERS
+
+    def test_stable(self):
+        assert assignments(4) == assignments(4)
+        assert OwnerPartition(["b", "a"], "a").filter(OWNERS) == OwnerPartition(
+            ["a", "b"], "a"
+        ).filter(OWNERS)
+
+    def test_balanced(self):
+        for count in (2, 4, 8):
+            sizes = [
+                len(OwnerPartition.numbered(i, count).filter(OWNERS))
+                for i in range(count)
+            ]
+            for size in sizes:
+                assert size > 0.6 * len(OWNERS) / count
+                assert size < 1.4 * len(OWNERS) / count
+
+    def test_adding_partition_moves_few_owners(self):
+        before = assignments(4)
+        after = assignments(5)
+        moved = [owner for owner in OWNERS if before[owner] != after[owner]]
+        # only owners taken over by the new partition move
+        assert all(after[owner] == "4" for owner in moved)
+        assert len(moved) < 0.35 * len(OWNERS)
+
+    def test_invalid_member(self):
+        with pytest.raises(ValueError):
+            OwnerPartition(["a", "b"], "c")
+        with pytest.raises(ValueError):
+            OwnerPartition.numbered(4, 4)
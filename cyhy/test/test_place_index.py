@@ -0,0 +1,81 @@
+#!/usr/bin/env py.test -v
+
+import math
+import random
+
+import pytest
+
+from cyhy.db import PlaceIndex
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * math.asin(math.sqrt(a))
+
+
+def place(_id, lon, lat, **kwargs):
+    doc = {"_id": _id, "longitude_dec": lon, "latitude_dec": lat}
+    doc.update(kwargs)
+    return doc
+
+
+@pytest.fixture
+def index():
+    return PlaceIndex(
+        [
+            place(1, -77.0365, 38.8977, name="Washington", state="DC"),
+            place(2, -76.6122, 39.2904, name="Baltimore", state="MD"),
+            place(3, -122.4194, 37.7749, name="San Francisco", state="CA"),
+            place(4, 179.9, -16.5, name="Labasa", country="FJ"),
+            place(5, 0.0, 0.0, name="Unknown"),  # GNIS unknown coordinates
+            {"_id": 6, "name": "Government unit without coordinates"},
+        ]
+    )
+
+
+class TestPlaceIndex:
+    def test_len_skips_places_without_coordinates(self, index):
+        assert len(index) == 4
+
+    def test_nearest_places(self, index):
+        results = index.nearest_places(
+            [(-77.0, 38.9), (-76.7, 39.3), (-121.9, 37.3), (-77.0, 38.9)]
+        )
+        assert [r["_id"] for r in results] == [1, 2, 3, 1]
+
+    def test_missing_locations(self, index):
+        assert index.nearest_places([None, (None, None), (-77.0, 38.9)])[:2] == [
+            None,
+            None,
+        ]
+
+    def test_antimeridian(self, index):
+        assert index.nearest_place((-179.9, -16.5))["_id"] == 4
+
+    def test_far_from_any_place(self, index):
+        # the only nearby cells are empty, so the search has to widen
+        assert index.nearest_place((-150.0, 60.0))["_id"] == 3
+
+    def test_empty_index(self):
+        assert PlaceIndex().nearest_places([(-77.0, 38.9)]) == [None]
+
+    def test_matches_brute_force(self):
+        rng = random.Random(1234)
+        places = [
+            place(i, rng.uniform(-180, 180), rng.uniform(-90, 90))
+            for i in range(1, 501)
+        ]
+        index = PlaceIndex(places, cell_degrees=5.0)
+        locs = [(rng.uniform(-180, 180), rng.uniform(-90, 90)) for _ in range(500)]
+        for loc, result in zip(locs, index.nearest_places(locs)):
+            expected = min(
+                places,
+                key=lambda p: haversine(
+                    loc[0], loc[1], p["longitude_dec"], p["latitude_dec"]
+                ),
+            )
+            assert result["_id"] == expected["_id"]
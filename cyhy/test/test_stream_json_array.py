@@ -0,0 +1,67 @@
+#!/usr/bin/env py.test -v
+
+from collections import OrderedDict
+import gzip
+import json
+from StringIO import StringIO
+
+import pytest
+
+import cyhy.util as util
+
+# scalar members must precede the array, as they do in the NVD feeds
+FEED = OrderedDict(
+    [
+        ("CVE_data_type", "CVE"),
+        ("CVE_data_numberOfCVEs", "3"),
+        ("CVE_Items", [
+            {"cve": {"id": "CVE-2020-0001"}, "score": 1.5},
+            {"cve": {"id": u"CVE-2020-0002 \u2603"}, "score": 10},
+            {"cve": {"id": "CVE-2020-0003"}, "nested": [[1, 2], {"a": "]"}]},
+        ]),
+    ]
+)
+
+
+@pytest.mark.parametrize("block_size", [1, 2, 7, 64, 1024 * 1024])
+def test_stream_json_array(block_size):
+    stream = StringIO(json.dumps(FEED, indent=2))
+    header, items = util.stream_json_array(stream, "CVE_Items", block_size)
+    assert header == {"CVE_data_type": "CVE", "CVE_data_numberOfCVEs": "3"}
+    assert list(items) == FEED["CVE_Items"]
+
+
+def test_stream_json_array_numbers():
+    stream = StringIO('{"values": [1, 22, 333.5, -4444]}')
+    header, items = util.stream_json_array(stream, "values", 1)
+    assert header == {}
+    assert list(items) == [1, 22, 333.5, -4444]
+
+
+def test_stream_json_array_missing_key():
+    with pytest.raises(ValueError):
+        util.stream_json_array(StringIO('{"other": []}'), "CVE_Items")
+
+
+def test_stream_json_array_truncated():
+    header, items = util.stream_json_array(
+        StringIO('{"CVE_Items": [{"a": 1}, {"b":'), "CVE_Items", 4
+    )
+    with pytest.raises(ValueError):
+        list(items)
+
+
+def test_gunzip_stream():
+    data = json.dumps(FEED) * 100
+    buf = StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode="wb")
+    gz.write(data)
+    gz.close()
+    stream = util.GunzipStream(StringIO(buf.getvalue()))
+    chunks = []
+    while True:
+        chunk = stream.read(1000)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    assert "".join(chunks) == data
@@ -814,3 +814,48 @@ class TestIPPortNonVulnScanTickets:
             ).count()
             == 1
         ), "collection should have 1 closed UNKNOWN_OWNER nmap ticket"
+
+
+class TestTicketDetails:
+    VULN = {
+        "cve": "CVE-2020-0001",
+        "cvss_base_score": 5.0,
+        "plugin_name": "Test Plugin",
+        "source": SOURCE_NESSUS,
+        "severity": 2,
+    }
+
+    def test_calculate_details_without_nvd(self):
+        details = VulnTicketManager.calculate_details(self.VULN)
+        assert details["score_source"] == SOURCE_NESSUS
+        assert details["severity"] == 2
+        assert details["kev"] is False
+
+    def test_calculate_details_with_nvd_and_kev(self):
+        cve_doc = {"cvss_score": 9.8, "cvss_version": "3.1", "severity": 4}
+        kev_doc = {"known_ransomware": True}
+        details = VulnTicketManager.calculate_details(self.VULN, cve_doc, kev_doc)
+        assert details["score_source"] == "nvd"
+        assert details["cvss_base_score"] == 9.8
+        assert details["severity"] == 4
+        assert details["kev"] is True
+        assert details["kev_ransomware"] is True
+
+    def test_delta_needs_notification(self):
+        old = VulnTicketManager.calculate_details(self.VULN)
+        new = VulnTicketManager.calculate_details(self.VULN, kev_doc={})
+        assert not VulnTicketManager.delta_needs_notification(
+            VulnTicketManager.calculate_delta(old, new)
+        )
+        new = VulnTicketManager.calculate_details(
+            self.VULN, kev_doc={"known_ransomware": False}
+        )
+        assert VulnTicketManager.delta_needs_notification(
+            VulnTicketManager.calculate_delta(old, new)
+        )
+        new = VulnTicketManager.calculate_details(
+            self.VULN, {"cvss_score": 7.5, "cvss_version": "3.1", "severity": 3}
+        )
+        assert VulnTicketManager.delta_needs_notification(
+            VulnTicketManager.calculate_delta(old, new)
+        )
@@ -18,11 +18,15 @@ __all__ = [
     "report_dates",
     "utcnow",
     "warn_and_confirm",
+    "stream_json_array",
+    "GunzipStream",
 ]
 
 import sys
 import itertools
 import json
+import re
+import zlib
 import bson
 from collections import OrderedDict
 import netaddr
@@ -273,3 +277,94 @@ def warn_and_confirm(message):
     print >> sys.stderr
     yes = raw_input('Type "yes" if you are sure that you want to continue: ')
     return yes == "yes"
+
+
+JSON_STREAM_BLOCK_SIZE = 64 * 1024
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def stream_json_array(stream, key, block_size=JSON_STREAM_BLOCK_SIZE):
+    """Incrementally parses a JSON object whose array member key follows its
+    scalar members (as in the NVD and KEV feeds).
+    Returns (header, items): header is a dict of the members preceding key,
+    and items is a generator of the array's elements, decoded one at a time so
+    memory use does not grow with the length of the array."""
+    key_regex = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    buf = ""
+    while True:
+        match = key_regex.search(buf)
+        if match:
+            break
+        block = stream.read(block_size)
+        if not block:
+            raise ValueError("JSON has no %r array" % key)
+        buf += block
+    try:
+        header = json.loads(buf[: match.start()].rstrip().rstrip(",") + "}")
+    except ValueError:
+        raise ValueError("JSON %r array is not a top-level member" % key)
+
+    def items(buf, pos):
+        decoder = json.JSONDecoder()
+        eof = False
+        while True:
+            pos = JSON_WHITESPACE.match(buf, pos).end()
+            if pos < len(buf) and buf[pos] == "]":
+                return
+            if pos < len(buf) and buf[pos] == ",":
+                pos += 1
+                continue
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+                # a number at the end of the buffer may continue in the next block
+                complete = eof or (end < len(buf) and buf[end] in ",] \t\n\r")
+            except ValueError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                block = stream.read(block_size)
+                buf = buf[pos:] + block
+                pos = 0
+                eof = not block
+                continue
+            yield item
+            pos = end
+            if pos >= block_size:
+                buf = buf[pos:]
+                pos = 0
+
+    return header, items(buf, match.end())
+
+
+class GunzipStream(object):
+    """Read-only file-like object that decompresses a gzip stream as it is
+    read.  Unlike gzip.GzipFile, the underlying file need not be seekable (e.g.
+    a urllib response)."""
+
+    def __init__(self, fileobj):
+        self.__fileobj = fileobj
+        self.__decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.__buf = ""
+        self.__eof = False
+
+    def read(self, size=-1):
+        while not self.__eof and (size < 0 or len(self.__buf) < size):
+            data = self.__fileobj.read(JSON_STREAM_BLOCK_SIZE)
+            if not data:
+                self.__buf += self.__decompressor.flush()
+                self.__eof = True
+                break
+            self.__buf += self.__decompressor.decompress(data)
+            while self.__decompressor.unused_data:
+                # concatenated gzip members
+                unused_data = self.__decompressor.unused_data
+                self.__decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self.__buf += self.__decompressor.decompress(unused_data)
+        if size < 0:
+            size = len(self.__buf)
+        data, self.__buf = self.__buf[:size], self.__buf[size:]
+        return data
+
+    def close(self):
+        self.__fileobj.close()
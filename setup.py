@@ -31,10 +31,10 @@ setup(
     long_description=open("README.md").read(),
     install_requires=[
         "docopt >= 0.6.2",
-        "geoip2 >= 2.3.0",
-        "maxminddb <2.0.0",
+        "maxminddb >= 1.5.0, <2.0.0",
         "mongokit >= 0.9.0",
         "netaddr >= 0.7.10",
+        "numpy >= 1.9.0",
         "pandas >= 0.16.2",  # TODO: test with 0.19.1
         "progressbar >=2.3-dev",
         "pycrypto >= 2.6",
@@ -24,6 +24,8 @@ from unidecode import unidecode
 
 from cyhy.db import database
 
+BULK_WRITE_SIZE = 10000
+
 # Data file source: https://www.usgs.gov/core-science-systems/ngp/board-on-geographic-names/download-gnis-data
 GOVT_UNITS_HEADER = "FEATURE_ID|UNIT_TYPE|COUNTY_NUMERIC|COUNTY_NAME|STATE_NUMERIC|STATE_ALPHA|STATE_NAME|COUNTRY_ALPHA|COUNTRY_NAME|FEATURE_NAME"
 POP_PLACES_HEADER = "FEATURE_ID|FEATURE_NAME|FEATURE_CLASS|STATE_ALPHA|STATE_NUMERIC|COUNTY_NAME|COUNTY_NUMERIC|PRIMARY_LAT_DMS|PRIM_LONG_DMS|PRIM_LAT_DEC|PRIM_LONG_DEC|SOURCE_LAT_DMS|SOURCE_LONG_DMS|SOURCE_LAT_DEC|SOURCE_LONG_DEC|ELEV_IN_M|ELEV_IN_FT|MAP_NAME|DATE_CREATED|DATE_EDITED"
@@ -43,28 +45,44 @@ def skip_comments(lines):
             yield line
 
 
-def import_govt_units(db, csv_reader):
+def bulk_upsert(db, docs):
+    """Upserts raw place documents in unordered batches of BULK_WRITE_SIZE.
+    Returns the number of documents written."""
+    collection = db.PlaceDoc.collection
+    count = 0
+    bulk = None
+    for doc in docs:
+        if bulk is None:
+            bulk = collection.initialize_unordered_bulk_op()
+        bulk.find({"_id": doc["_id"]}).upsert().replace_one(doc)
+        count += 1
+        if count % BULK_WRITE_SIZE == 0:
+            bulk.execute()
+            bulk = None
+    if bulk is not None:
+        bulk.execute()
+    return count
+
+
+def govt_unit_docs(csv_reader):
     for line in csv_reader:
-        placeDoc = db.PlaceDoc(
-            {
-                "_id": long(line["FEATURE_ID"]),
-                "class": line["UNIT_TYPE"],
-                "county_fips": line["COUNTY_NUMERIC"],
-                "county": line["COUNTY_NAME"],
-                "state_fips": line["STATE_NUMERIC"],
-                "state": line["STATE_ALPHA"],
-                "state_name": line["STATE_NAME"],
-                "country": line["COUNTRY_ALPHA"],
-                "country_name": line["COUNTRY_NAME"],
-                "name": line["FEATURE_NAME"],
-            }
-        )
-        placeDoc.save()
+        yield {
+            "_id": long(line["FEATURE_ID"]),
+            "class": line["UNIT_TYPE"],
+            "county_fips": line["COUNTY_NUMERIC"],
+            "county": line["COUNTY_NAME"],
+            "state_fips": line["STATE_NUMERIC"],
+            "state": line["STATE_ALPHA"],
+            "state_name": line["STATE_NAME"],
+            "country": line["COUNTRY_ALPHA"],
+            "country_name": line["COUNTRY_NAME"],
+            "name": line["FEATURE_NAME"],
+        }
 
 
-def import_populated_places(db, csv_reader):
+def populated_place_docs(db, csv_reader):
     # IMPORTANT: This import must be done AFTER import_govt_units()
-    all_states = db.PlaceDoc.find({"class": "STATE"})
+    all_states = db.PlaceDoc.collection.find({"class": "STATE"})
     state_lookup = dict()
     for state in all_states:
         state_lookup[state["state"]] = {
@@ -74,35 +92,51 @@ def import_populated_places(db, csv_reader):
         }
 
     for line in csv_reader:
-        placeDoc = db.PlaceDoc(
-            {
-                "_id": long(line["FEATURE_ID"]),
-                "name": line["FEATURE_NAME"],
-                "class": line["FEATURE_CLASS"],
-                "state": line["STATE_ALPHA"],
-                "state_fips": line["STATE_NUMERIC"],
-                "county": line["COUNTY_NAME"],
-                "county_fips": line["COUNTY_NUMERIC"],
-                "latitude_dms": line["PRIMARY_LAT_DMS"],
-                "longitude_dms": line["PRIM_LONG_DMS"],
-                "latitude_dec": float(line["PRIM_LAT_DEC"]),
-                "longitude_dec": float(line["PRIM_LONG_DEC"]),
-            }
-        )
+        doc = {
+            "_id": long(line["FEATURE_ID"]),
+            "name": line["FEATURE_NAME"],
+            "class": line["FEATURE_CLASS"],
+            "state": line["STATE_ALPHA"],
+            "state_fips": line["STATE_NUMERIC"],
+            "county": line["COUNTY_NAME"],
+            "county_fips": line["COUNTY_NUMERIC"],
+            "latitude_dms": line["PRIMARY_LAT_DMS"],
+            "longitude_dms": line["PRIM_LONG_DMS"],
+            "latitude_dec": float(line["PRIM_LAT_DEC"]),
+            "longitude_dec": float(line["PRIM_LONG_DEC"]),
+        }
         if line["ELEV_IN_M"]:
-            placeDoc["elevation_meters"] = int(line["ELEV_IN_M"])
+            doc["elevation_meters"] = int(line["ELEV_IN_M"])
         else:
-            placeDoc["elevation_meters"] = None
+            doc["elevation_meters"] = None
 
         if line["ELEV_IN_FT"]:
-            placeDoc["elevation_feet"] = int(line["ELEV_IN_FT"])
+            doc["elevation_feet"] = int(line["ELEV_IN_FT"])
         else:
-            placeDoc["elevation_feet"] = None
+            doc["elevation_feet"] = None
+
+        loc = database.PlaceDoc.loc_of(doc)
+        if loc is not None:
+            doc["loc"] = loc
 
-        placeDoc["state_name"] = state_lookup[placeDoc["state"]]["state_name"]
-        placeDoc["country"] = state_lookup[placeDoc["state"]]["country"]
-        placeDoc["country_name"] = state_lookup[placeDoc["state"]]["country_name"]
-        placeDoc.save()
+        doc.update(state_lookup[doc["state"]])
+        yield doc
+
+
+def import_govt_units(db, csv_reader):
+    return bulk_upsert(db, govt_unit_docs(csv_reader))
+
+
+def import_populated_places(db, csv_reader):
+    # IMPORTANT: This import must be done AFTER import_govt_units()
+    return bulk_upsert(db, populated_place_docs(db, csv_reader))
+
+
+def ensure_place_indices(db):
+    for name, spec, unique, sparse in db.PlaceDoc.get_indices():
+        db.PlaceDoc.collection.ensure_index(
+            spec, name=name, unique=unique, sparse=sparse
+        )
 
 
 def main():
@@ -119,14 +153,17 @@ def main():
         header_line = "|".join(csv_reader.fieldnames)
 
         if header_line == GOVT_UNITS_HEADER:
-            import_govt_units(db, csv_reader)
+            count = import_govt_units(db, csv_reader)
         elif header_line == POP_PLACES_HEADER:
-            import_populated_places(
+            count = import_populated_places(
                 db, csv_reader
             )  # IMPORTANT: This import must be done AFTER import_govt_units()
         else:
             print("ERROR: Unknown header line found in: {}".format(args["PLACES_FILE"]))
             sys.exit(-1)
+    print("Imported {:,} places".format(count))
+
+    ensure_place_indices(db)
 
     # import IPython; IPython.embed() #<<< BREAKPOINT >>>
     # sys.exit(0)